@@ -3,9 +3,24 @@ from cogs.utils.dataIO import dataIO
 from cogs.utils import checks
 import os
 import re
+import logging
+import asyncio
+import threading
+import time
+import shutil
+import gzip
+import io
+import mmap
+import struct
+import zlib
+import multiprocessing
 import aiohttp
+import json
 import copy
-from datetime import timezone
+import weakref
+from collections import OrderedDict, deque
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
 
 try:  # check if BeautifulSoup4 is installed
     from bs4 import BeautifulSoup
@@ -14,6 +29,2207 @@ try:  # check if BeautifulSoup4 is installed
 except:
     soupAvailable = False
 
+log = logging.getLogger("red.gnu")
+
+
+class ChatLog:
+    """ Chat log for a single channel
+
+    The log is stored as a directory of segment files. Lines are appended to the newest segment, and a new segment
+    is started once it reaches segment_size. When the log grows past max_size the oldest segment is dropped whole,
+    so rotation never rewrites data.
+
+    A sparse line index is kept next to the segments so that line-addressed reads can seek straight to the lines
+    they need. For each segment it records the segment size, the number of lines, and the byte offset of every
+    index_interval-th line. It also records the timestamps of each index_interval-line block (the timestamp of
+    its first line, and the lowest and highest timestamps in it) so that reads of a time range only have to look
+    at the blocks that overlap it. Lines without a timestamp, i.e. the rest of a multi-line message, take the
+    timestamp of the line before them. Index entries that do not match their segment (e.g. after a crash) are rebuilt from
+    the segment itself.
+
+    The index also keeps running line, word and character counts of each segment's text, counted the way wc counts
+    streamed input, so that the counts of the whole log are the sum over its segments and stay right as old segments
+    are dropped. Entries saved by older versions have no counts; their segments are counted once when the index is
+    loaded, and the index is saved with the counts.
+
+    Lines are either in the classic text form or, for channels with structured logging, JSON objects written by
+    :class:`LogRecord`. Both kinds may appear in the same log; JSON lines are projected back to the text form as
+    they are read, so readers only ever see text.
+
+    Optionally, a trigram index is kept for each segment to speed up grep. For each index_interval-line block it
+    keeps a bloom filter of the trigrams of the case-folded text, trigram_bits bits with two bits set per trigram,
+    so a search only has to read and check the blocks that may contain every trigram of the search string.
+    Trigram indexes are saved next to their segments in a compact binary form, and kept in memory once loaded;
+    the newest segment's index is updated as lines are appended and saved when the segment is closed.
+
+    Optionally, full segments are gzip compressed. Offsets in the indexes always refer to the uncompressed data,
+    and compressed segments are decompressed as they are read.
+
+    Attributes
+    ----------
+    path     : str   directory containing segment files
+    segments : list  segment names, oldest first; a compressed segment is stored in a file named name + ".gz"
+    sizes    : dict  size in bytes of each segment on disk {name: size}
+    compressed : set  names of compressed segments
+    handle   : file  open handle for the newest segment, or None
+    index    : dict  line index {name: {"size": int, "lines": int, "offsets": [int, ...],
+                                          "times": [[first, lo, hi], ...], "last": str, "gz": int,
+                                          "wc": [lines, words, chars]}};
+                     "size" is the uncompressed size and "gz" the compressed size; None until loaded
+    trigrams : dict  loaded trigram indexes {name: (segment size, [bloom filter bytearray of each block, ...])};
+                     an index whose size does not match its segment is out of date
+    lock     : :class:`RLock`  guards segments and indexes between the writer and readers
+    """
+
+    segment_format = "{0:010d}.log"
+    index_name = "index.json"
+    index_interval = 128
+    json_prefix = '{"ts": '
+    timestamp_pattern = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) |\{"ts": (\d+)')
+    timestamp_bytes_pattern = re.compile(rb'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) |\{"ts": (\d+)')
+    trigram_bits = 1 << 14  # at most 1 << 16, as both bits of a trigram are taken from one crc32
+    trigram_header = struct.Struct("<8sQI")  # magic, segment size, trigram_bits
+    trigram_magic = b"GNUTRI1\n"
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+        self.index = None
+        self.trigrams = {}
+        self.lock = threading.RLock()
+        self._finish_prepend()
+        self._migrate()
+        files = set(os.listdir(path)) if os.path.isdir(path) else set()
+        self.segments = sorted(f for f in files if f.endswith(".log"))
+        self.compressed = set()
+        for file in files:
+            if file.endswith(".log.gz"):
+                if file[:-len(".gz")] in files:
+                    # compression did not finish removing the uncompressed segment
+                    os.remove(os.path.join(path, file))
+                else:
+                    self.segments.append(file[:-len(".gz")])
+                    self.compressed.add(file[:-len(".gz")])
+        self.segments.sort()
+        self.sizes = {name: os.path.getsize(self._segment_path(name)) for name in self.segments}
+
+    def size(self) -> int:
+        """Total size of log on disk in bytes"""
+        return sum(self.sizes.values())
+
+    def raw_size(self) -> int:
+        """Total uncompressed size of log in bytes; may block while the index is loaded"""
+        with self.lock:
+            self._load_index()
+            return sum(self.index[name]["size"] for name in self.segments)
+
+    def line_count(self) -> int:
+        """Total number of lines in log; may block while the index is loaded"""
+        with self.lock:
+            self._load_index()
+            return sum(self.index[name]["lines"] for name in self.segments)
+
+    def counts(self) -> tuple:
+        """Line, word and character counts of log text as (lines, words, chars); may block while the index is
+        loaded
+        """
+        with self.lock:
+            self._load_index()
+            return tuple(sum(self.index[name]["wc"][i] for name in self.segments) for i in range(3))
+
+    def read_lines(self, start: int, stop: int = None) -> list:
+        """Read lines [start, stop) of log into a list; blocks
+        :param start:  number of first line to read, starting from 0
+        :param stop:   number of line to stop at; None to read to the end of the log
+        :return:       list of lines without line endings
+        """
+        return [line for lines in self.iter_lines(start, stop) for line in lines]
+
+    def iter_lines(self, start: int = 0, stop: int = None, chunk_size: int = 65536):
+        """Generate lines [start, stop) of log in lists, seeking to the nearest indexed line; blocks
+        :param start:       number of first line to read, starting from 0
+        :param stop:        number of line to stop at; None to read to the end of the log
+        :param chunk_size:  number of bytes read from disk at a time
+        :return:            generator of non-empty lists of lines without line endings
+        """
+        k = self.index_interval
+        with self.lock:
+            self._load_index()
+            entries = [(name, dict(self.index[name])) for name in self.segments]
+
+        first = 0  # number of first line in segment
+        for name, entry in entries:
+            if stop is not None and first >= stop:
+                break
+            if first + entry["lines"] <= start:
+                first += entry["lines"]
+                continue
+
+            # seek to indexed line at or before start, and read up to indexed line at or after stop
+            block = max(start - first, 0) // k
+            begin = entry["offsets"][block]
+            end = entry["size"]
+            if stop is not None and (stop - first + k - 1) // k < len(entry["offsets"]):
+                end = entry["offsets"][(stop - first + k - 1) // k]
+            skip = max(start - first, 0) - block * k  # lines to skip after begin
+            take = None if stop is None else stop - first - block * k  # lines to stop at after begin
+            try:
+                f = self._open_segment(name)
+            except FileNotFoundError:
+                # segment was dropped after the index was read
+                first += entry["lines"]
+                continue
+
+            with f:
+                f.seek(begin)
+                remaining = end - begin
+                partial = b""
+                count = 0  # lines read after begin
+                while remaining > 0 and (take is None or count < take):
+                    data = f.read(min(chunk_size, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    data = partial + data
+                    cut = data.rfind(b"\n")
+                    if cut == -1:
+                        partial = data
+                        continue
+                    partial = data[cut + 1:]
+                    lines = self._decode(data[:cut])
+                    lo = max(skip - count, 0)
+                    hi = len(lines) if take is None else min(len(lines), take - count)
+                    count += len(lines)
+                    if lo < hi:
+                        yield lines[lo:hi]
+            first += entry["lines"]
+
+    def iter_lines_reversed(self, block_size: int = 65536):
+        """Generate lines of log in lists, newest first, reading blocks backwards from the end; blocks
+        :param block_size:  number of bytes read from disk at a time
+        :return:            generator of non-empty lists of lines without line endings, last line first
+        """
+        with self.lock:
+            self._load_index()
+            entries = [(name, self.index[name]["size"]) for name in self.segments]
+
+        for name, size in reversed(entries):
+            try:
+                f = self._open_segment(name)
+            except FileNotFoundError:
+                # segment was dropped after the file list was taken
+                continue
+            if isinstance(f, gzip.GzipFile):
+                # seeking backwards in a gzip file restarts decompression, so decompress the segment once
+                with f:
+                    f = io.BytesIO(f.read(size))
+
+            with f:
+                pos = size
+                partial = b""  # start of the earliest line read so far, which may continue in the previous block
+                at_end = True
+                while pos > 0:
+                    read = min(block_size, pos)
+                    pos -= read
+                    f.seek(pos)
+                    data = f.read(read) + partial
+                    if pos > 0:
+                        cut = data.find(b"\n")
+                        if cut == -1:
+                            partial = data
+                            continue
+                        partial = data[:cut]
+                        data = data[cut + 1:]
+                    lines = self._decode(data)
+                    if at_end:
+                        # drop empty string after the newline that ends the segment
+                        if lines[-1] == "":
+                            lines.pop()
+                        at_end = False
+                    if lines:
+                        lines.reverse()
+                        yield lines
+
+    def read_last_lines(self, n: int) -> list:
+        """Read the last n lines of log into a list, oldest first; blocks"""
+        lines = []
+        if n > 0:
+            for batch in self.iter_lines_reversed():
+                lines.extend(batch)
+                if len(lines) >= n:
+                    break
+        lines = lines[:n]
+        lines.reverse()
+        return lines
+
+    def iter_select(self, literals=(), time_range=None, numbered=True, fields=None):
+        """Generate lines from blocks that may contain all literals and that overlap a time range; blocks
+
+        Blocks are chosen with the trigram index and the time index. Lines outside the time range or that do not
+        match fields are dropped, but lines that do not contain the literals are not, so they still have to be
+        checked by the caller.
+
+        :param literals:    strings that every matching line must contain, ignoring case
+        :param time_range:  (since, until) strings compared against line timestamps; None for all lines
+        :param numbered:    if true, generate (line number, line) tuples instead of lines
+        :param fields:      {"author": id or name#discriminator, "kind": "new" or "edit"} that JSON lines must
+                            match; text lines never match. None for all lines
+        :return:            generator of non-empty lists of lines or (line number, line) tuples
+        """
+        k = self.index_interval
+        bits = self._trigram_positions(literals)
+        with self.lock:
+            self._load_index()
+            entries = [(name, dict(self.index[name])) for name in self.segments]
+
+        first = 0  # number of first line in segment
+        for name, entry in entries:
+            mask = (1 << len(entry["offsets"])) - 1
+            if time_range is not None:
+                for block, (_, lo, hi) in enumerate(entry["times"]):
+                    if hi < time_range[0] or lo > time_range[1]:
+                        mask &= ~(1 << block)
+            if bits and mask:
+                mask &= self._trigram_mask(name, bits)
+            if not mask:
+                first += entry["lines"]
+                continue
+
+            try:
+                f = self._open_segment(name)
+            except FileNotFoundError:
+                first += entry["lines"]
+                continue
+            with f:
+                for block in range(len(entry["offsets"])):
+                    if not mask >> block & 1:
+                        continue
+                    begin = entry["offsets"][block]
+                    end = entry["offsets"][block + 1] if block + 1 < len(entry["offsets"]) else entry["size"]
+                    f.seek(begin)
+                    lines = enumerate(f.read(end - begin).decode("utf-8", "replace").split("\n")[:-1],
+                                      first + block * k)
+                    if time_range is not None:
+                        lines = self._filter_time(lines, entry["times"][block][0], time_range)
+                    if fields:
+                        lines = self._filter_fields(lines, fields)
+                    else:
+                        lines = ((num, self._text(line)) for num, line in lines)
+                    lines = list(lines) if numbered else [line for _, line in lines]
+                    if lines:
+                        yield lines
+            first += entry["lines"]
+
+    def iter_search(self, pattern, bytes_pattern, invert=False, batch_size=1024, literals=()):
+        """Generate (line number, line) tuples of lines that match a regex, scanning raw bytes; blocks
+
+        Segments are memory mapped (compressed ones are decompressed) and bytes_pattern is run over the raw data,
+        so only the lines around each hit are decoded. Segments that contain JSON lines are decoded and checked
+        with pattern instead, since their raw bytes are not the text that is searched. If literals are given,
+        only the blocks that the trigram index says may contain them are searched.
+
+        :param pattern:        compiled str regex
+        :param bytes_pattern:  compiled bytes regex that matches a line's UTF-8 bytes exactly when pattern matches
+                               the line; must not match across line endings
+        :param invert:         if true, generate lines that do not match instead
+        :param batch_size:     number of tuples after which a list is generated
+        :param literals:       strings that every matching line contains, ignoring case; ignored if invert is set
+        :return:               generator of non-empty lists of (line number, line) tuples
+        """
+        k = self.index_interval
+        bits = () if invert else self._trigram_positions(literals)
+        with self.lock:
+            self._load_index()
+            entries = [(name, dict(self.index[name])) for name in self.segments]
+
+        first = 0  # number of first line in segment
+        for name, entry in entries:
+            size = entry["size"]
+            if not size:
+                continue
+            mask = (1 << len(entry["offsets"])) - 1
+            if bits:
+                mask &= self._trigram_mask(name, bits)
+                if not mask:
+                    first += entry["lines"]
+                    continue
+            # byte ranges of runs of blocks to search
+            ranges = []
+            for block in range(len(entry["offsets"])):
+                if mask >> block & 1:
+                    end = entry["offsets"][block + 1] if block + 1 < len(entry["offsets"]) else size
+                    if ranges and ranges[-1][1] == entry["offsets"][block]:
+                        ranges[-1][1] = end
+                    else:
+                        ranges.append([entry["offsets"][block], end])
+            try:
+                f = self._open_segment(name)
+            except FileNotFoundError:
+                first += entry["lines"]
+                continue
+            with f:
+                if isinstance(f, gzip.GzipFile):
+                    data = f.read(size)
+                else:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if data.find(self.json_prefix.encode("ascii"), 0, size) != -1:
+                    lines = enumerate(self._decode(data[:size])[:entry["lines"]], first)
+                    lines = [(num, line) for num, line in lines
+                             if mask >> (num - first) // k & 1 and bool(pattern.search(line)) != invert]
+                    for i in range(0, len(lines), batch_size):
+                        yield lines[i:i + batch_size]
+                    first += entry["lines"]
+                    continue
+
+                batch = []
+                pos = 0  # start of next line to check
+                pos_num = 0  # number of that line within segment
+                for begin, stop in ranges:
+                    pos = max(pos, begin)
+                    while pos < stop:
+                        match = bytes_pattern.search(data, pos, stop)
+                        if match is None:
+                            if not invert:
+                                break
+                            start = end = stop
+                        else:
+                            start = data.rfind(b"\n", pos, match.start()) + 1 or pos
+                            end = data.find(b"\n", match.start(), stop)
+                            if end == -1:
+                                end = stop
+
+                        # count lines up to start from pos, or from the nearest indexed line if that is closer
+                        block = bisect_right(entry["offsets"], start) - 1
+                        base, num = max((pos, pos_num), (entry["offsets"][block], block * k))
+                        num += data[base:start].count(b"\n")
+
+                        if invert and start > pos:
+                            skipped = data[pos:start]
+                            if skipped.endswith(b"\n"):
+                                skipped = skipped[:-1]
+                            batch.extend(enumerate(skipped.decode("utf-8", "replace").split("\n"), first + pos_num))
+                        elif not invert and match is not None:
+                            batch.append((first + num, data[start:end].decode("utf-8", "replace")))
+                        if len(batch) >= batch_size:
+                            yield batch
+                            batch = []
+                        pos = end + 1
+                        pos_num = num + 1
+                if batch:
+                    yield batch
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+            first += entry["lines"]
+
+    def _filter_time(self, lines, timestamp, time_range):
+        """Generate (line number, line) tuples whose timestamp is in time_range
+        :param lines:      (line number, line) tuples
+        :param timestamp:  timestamp of the first line, used if it is the continuation of a multi-line message
+        """
+        for num, line in lines:
+            match = self.timestamp_pattern.match(line)
+            if match:
+                timestamp = self._match_time(match)
+            if time_range[0] <= timestamp <= time_range[1]:
+                yield num, line
+
+    @staticmethod
+    def _filter_fields(lines, fields):
+        """Generate (line number, line) tuples of JSON lines that match fields, with lines projected to text"""
+        author = fields.get("author")
+        kind = fields.get("kind")
+        for num, line in lines:
+            record = LogRecord.from_json(line)
+            if record is None:
+                continue
+            if author is not None and author not in (record.author_id, record.author()):
+                continue
+            if kind is not None and kind != record.kind:
+                continue
+            yield num, record.text()
+
+    @classmethod
+    def _text(cls, line) -> str:
+        """Project line to the text form"""
+        if line.startswith(cls.json_prefix):
+            record = LogRecord.from_json(line)
+            if record is not None:
+                return record.text()
+        return line
+
+    def _decode(self, data) -> list:
+        """Split data into lines, projecting JSON lines to the text form"""
+        lines = data.decode("utf-8", "replace").split("\n")
+        if self.json_prefix.encode("ascii") in data:
+            lines = [self._text(line) for line in lines]
+        return lines
+
+    @staticmethod
+    def _match_time(match) -> str:
+        """Local time string of a timestamp_pattern or timestamp_bytes_pattern match"""
+        if match.group(1) is not None:
+            timestamp = match.group(1)
+            return timestamp if isinstance(timestamp, str) else timestamp.decode("ascii")
+        return datetime.fromtimestamp(int(match.group(2))).strftime("%Y-%m-%d %H:%M:%S")
+
+    def trigram_size(self) -> int:
+        """Size in bytes of saved trigram indexes"""
+        size = 0
+        for name in list(self.segments):
+            try:
+                size += os.path.getsize(self._trigram_path(name))
+            except FileNotFoundError:
+                pass
+        return size
+
+    def rebuild_trigrams(self):
+        """Rebuild trigram indexes of all segments from the segments themselves; blocks"""
+        with self.lock:
+            self._load_index()
+            self.trigrams = {}
+            for name in self.segments:
+                try:
+                    os.remove(self._trigram_path(name))
+                except FileNotFoundError:
+                    pass
+                self._load_trigrams(name)
+                self._save_trigrams(name)
+
+    def append(self, data: bytes, segment_size: int, max_size: int, sync=False, trigrams=False, compress=False):
+        """Append data to log, starting new segments or dropping old ones as needed
+        :param data:          complete lines to append; data that does not fit in the newest segment is split
+                              between lines into new segments, but lines are never split across segments
+        :param segment_size:  start a new segment once the newest one reaches this size
+        :param max_size:      drop oldest segments while the log is larger than this
+        :param sync:          fsync segments when they are closed
+        :param trigrams:      keep trigram index of the newest segment up to date
+        :param compress:      compress full segments
+        """
+        with self.lock:
+            self._load_index()
+            while data:
+                if (not self.segments or self.sizes[self.segments[-1]] >= segment_size
+                        or self.segments[-1] in self.compressed):
+                    self._new_segment(sync)
+                    if compress:
+                        for name in self.segments[:-1]:
+                            if name not in self.compressed:
+                                self._compress(name)
+                name = self.segments[-1]
+
+                # take as many lines as fit in the segment, but at least one
+                piece = data
+                room = segment_size - self.sizes[name]
+                if len(data) > room:
+                    cut = data.rfind(b"\n", 0, room) + 1
+                    if not cut:
+                        cut = data.find(b"\n") + 1 or len(data)
+                    piece = data[:cut]
+                data = data[len(piece):]
+
+                blocks = self._load_trigrams(name) if trigrams else None
+                if self.handle is None:
+                    self.handle = open(os.path.join(self.path, name), mode="ab")
+                self.handle.write(piece)
+                self.handle.flush()
+                self.sizes[name] += len(piece)
+                if blocks is not None:
+                    self._index_trigrams(blocks, piece, self.index[name]["lines"])
+                self._index_data(self.index[name], piece)
+                if blocks is not None:
+                    self.trigrams[name] = (self.index[name]["size"], blocks)
+
+            # drop oldest segments, but always keep the one being written to
+            while len(self.segments) > 1 and self.size() > max_size:
+                name = self.segments.pop(0)
+                del self.sizes[name]
+                del self.index[name]
+                self.trigrams.pop(name, None)
+                self.compressed.discard(name)
+                for file in (os.path.join(self.path, name), os.path.join(self.path, name + ".gz"),
+                             self._trigram_path(name)):
+                    try:
+                        os.remove(file)
+                    except FileNotFoundError:
+                        pass
+
+            dataIO.save_json(os.path.join(self.path, self.index_name), self.index)
+
+    def first_time(self) -> str:
+        """Timestamp of the first line of log; None if log is empty. May block while the index is loaded"""
+        with self.lock:
+            self._load_index()
+            for name in self.segments:
+                if self.index[name]["times"]:
+                    return self.index[name]["times"][0][0] or None
+        return None
+
+    def iter_raw(self):
+        """Generate the uncompressed contents of each segment as stored, oldest first; blocks"""
+        with self.lock:
+            self._load_index()
+            entries = [(name, self.index[name]["size"]) for name in self.segments]
+        for name, size in entries:
+            try:
+                with self._open_segment(name) as f:
+                    data = f.read(size)
+            except FileNotFoundError:
+                continue
+            if data and not data.endswith(b"\n"):
+                data += b"\n"
+            yield data
+
+    def sync(self):
+        """fsync newest segment if open"""
+        if self.handle is not None:
+            os.fsync(self.handle.fileno())
+
+    def close(self, sync=False):
+        """Close newest segment if open"""
+        if self.segments:
+            self._save_trigrams(self.segments[-1])
+        if self.handle is None:
+            return
+        if sync:
+            self.sync()
+        self.handle.close()
+        self.handle = None
+
+    def delete(self) -> bool:
+        """Close and delete all segments; returns False if log did not exist"""
+        with self.lock:
+            self.close()
+            if not os.path.isdir(self.path):
+                return False
+            shutil.rmtree(self.path)
+            self.segments = []
+            self.sizes = {}
+            self.compressed = set()
+            self.index = None
+            self.trigrams = {}
+            return True
+
+    def _new_segment(self, sync):
+        """Close newest segment and start a new one"""
+        self.close(sync)
+        if self.segments:
+            num = int(self.segments[-1][:-len(".log")]) + 1
+        else:
+            num = 0
+            os.makedirs(self.path, exist_ok=True)
+        name = self.segment_format.format(num)
+        last = self.index[self.segments[-1]]["last"] if self.segments else ""
+        self.segments.append(name)
+        self.sizes[name] = 0
+        self.index[name] = {"size": 0, "lines": 0, "offsets": [0], "times": [], "last": last, "wc": [0, 0, 0]}
+
+    def _load_index(self):
+        """Load line index if not loaded, rebuilding entries that do not match their segment"""
+        if self.index is not None:
+            return
+        index_path = os.path.join(self.path, self.index_name)
+        saved = dataIO.load_json(index_path) if dataIO.is_valid_json(index_path) else {}
+        self.index = {}
+        last = ""
+        changed = False
+        for name in self.segments:
+            entry = saved.get(name)
+            if name in self.compressed:
+                valid = entry is not None and entry.get("gz") == self.sizes[name]
+            else:
+                valid = entry is not None and entry["size"] == self.sizes[name] and "gz" not in entry
+            if not valid or "times" not in entry:
+                entry = {"size": 0, "lines": 0, "offsets": [0], "times": [], "last": last, "wc": [0, 0, 0]}
+                if name in self.compressed:
+                    entry["gz"] = self.sizes[name]
+                with self._open_segment(name) as f:
+                    partial = b""
+                    for data in iter(lambda: f.read(65536), b""):
+                        data = partial + data
+                        cut = data.rfind(b"\n") + 1
+                        partial = data[cut:]
+                        if cut:
+                            self._index_data(entry, data[:cut])
+                    if partial:
+                        self._index_data(entry, partial)
+                        # the last line has no newline, but is read as a line
+                        self._count_text(entry["wc"], partial + b"\n")
+                changed = True
+            elif "wc" not in entry:
+                # entry saved before text counts were kept; count its segment once
+                entry["wc"] = [0, 0, 0]
+                with self._open_segment(name) as f:
+                    partial = b""
+                    for data in iter(lambda: f.read(65536), b""):
+                        data = partial + data
+                        cut = data.rfind(b"\n") + 1
+                        partial = data[cut:]
+                        self._count_text(entry["wc"], data[:cut])
+                    if partial:
+                        self._count_text(entry["wc"], partial + b"\n")
+                changed = True
+            self.index[name] = entry
+            last = entry["last"]
+        if changed:
+            dataIO.save_json(index_path, self.index)
+
+    def _index_data(self, entry, data):
+        """Update index entry with complete lines appended to its segment"""
+        k = self.index_interval
+        pattern = self.timestamp_bytes_pattern
+        times = entry["times"]
+        start = 0
+        while start < len(data):
+            # update timestamps of block
+            match = pattern.match(data, start)
+            if match:
+                entry["last"] = self._match_time(match)
+            timestamp = entry["last"]
+            block = entry["lines"] // k
+            if block == len(times):
+                times.append([timestamp, timestamp, timestamp])
+            elif timestamp < times[block][1]:
+                times[block][1] = timestamp
+            elif timestamp > times[block][2]:
+                times[block][2] = timestamp
+
+            # update line count and offsets
+            end = data.find(b"\n", start)
+            if end == -1:
+                break
+            entry["lines"] += 1
+            if entry["lines"] % k == 0:
+                entry["offsets"].append(entry["size"] + end + 1)
+            start = end + 1
+        entry["size"] += len(data)
+
+        self._count_text(entry["wc"], data)
+
+    def _count_text(self, counts, data):
+        """Add line, word and character counts of complete lines in data to counts, as wc counts streamed lines"""
+        cut = data.rfind(b"\n")
+        if cut == -1:
+            return
+        for line in self._decode(data[:cut]):
+            counts[0] += line.count("\n") + 1
+            counts[1] += len(line.split())
+            counts[2] += len(line) + 1
+
+    def _segment_path(self, name):
+        """Path of segment file"""
+        if name in self.compressed:
+            return os.path.join(self.path, name + ".gz")
+        return os.path.join(self.path, name)
+
+    def _open_segment(self, name):
+        """Open segment for reading, decompressing it if needed"""
+        path = os.path.join(self.path, name)
+        try:
+            return open(path, mode="rb")
+        except FileNotFoundError:
+            # segment is compressed, possibly after the caller took its list of segments
+            return gzip.open(path + ".gz", mode="rb")
+
+    def _compress(self, name):
+        """Replace full segment with a gzip compressed copy"""
+        path = os.path.join(self.path, name)
+        with open(path, mode="rb") as src, gzip.open(path + ".gz.tmp", mode="wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(path + ".gz.tmp", path + ".gz")
+        self.compressed.add(name)
+        os.remove(path)
+        self.sizes[name] = os.path.getsize(path + ".gz")
+        self.index[name]["gz"] = self.sizes[name]
+
+    def _trigram_path(self, name):
+        """Path of trigram index for segment"""
+        return os.path.join(self.path, name[:-len(".log")] + ".tri")
+
+    def _load_trigrams(self, name) -> list:
+        """Get trigram index for segment from memory or disk, rebuilding it if it does not match the segment
+        :return:  bloom filter of each block of segment
+        """
+        size = self.index[name]["size"]
+        if name in self.trigrams and self.trigrams[name][0] == size:
+            return self.trigrams[name][1]
+        blocks = self._read_trigrams(name, size)
+        built = blocks is None
+        if built:
+            blocks = []
+            if size:
+                with self._open_segment(name) as f:
+                    self._index_trigrams(blocks, f.read(size), 0)
+        self.trigrams[name] = (size, blocks)
+        if built and name != self.segments[-1]:
+            # full segments do not change, so save their index now
+            self._save_trigrams(name)
+        return blocks
+
+    def _read_trigrams(self, name, size):
+        """Read saved trigram index of segment; None if there is none or it does not match the segment"""
+        nbytes = self.trigram_bits // 8
+        try:
+            with open(self._trigram_path(name), mode="rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        header = self.trigram_header
+        if len(data) < header.size or (len(data) - header.size) % nbytes:
+            return None
+        if header.unpack_from(data) != (self.trigram_magic, size, self.trigram_bits):
+            return None
+        return [bytearray(data[i:i + nbytes]) for i in range(header.size, len(data), nbytes)]
+
+    def _save_trigrams(self, name):
+        """Save trigram index of segment if it is loaded and up to date"""
+        if name not in self.index or name not in self.trigrams:
+            return
+        size, blocks = self.trigrams[name]
+        if size != self.index[name]["size"]:
+            return
+        path = self._trigram_path(name)
+        with open(path + ".tmp", mode="wb") as f:
+            f.write(self.trigram_header.pack(self.trigram_magic, size, self.trigram_bits))
+            for block in blocks:
+                f.write(block)
+        os.replace(path + ".tmp", path)
+
+    def _trigram_mask(self, name, bits) -> int:
+        """Bitmask of the blocks of segment whose bloom filters have all bits set; 0 if segment was dropped
+        :param bits:  (byte, bit) positions from _trigram_positions
+        """
+        with self.lock:
+            if name not in self.index:
+                return 0
+            blocks = self._load_trigrams(name)
+        mask = 0
+        for block, bloom in enumerate(blocks):
+            if all(bloom[byte] & bit for byte, bit in bits):
+                mask |= 1 << block
+        return mask
+
+    def _trigram_positions(self, literals) -> list:
+        """(byte, bit) positions in a block's bloom filter of the trigrams of literals, ignoring case"""
+        bits = set()
+        for literal in literals:
+            for gram in self._trigrams(self._fold(literal)):
+                bits.update(self._trigram_bits(gram))
+        return [(pos >> 3, 1 << (pos & 7)) for pos in bits]
+
+    def _trigram_bits(self, gram) -> tuple:
+        """Positions of the two bits of a trigram in a block's bloom filter"""
+        h = zlib.crc32(gram.encode("utf-8"))
+        return h % self.trigram_bits, (h >> 16) % self.trigram_bits
+
+    def _index_trigrams(self, blocks, data, first_line):
+        """Add trigrams of lines in data to the bloom filters of their blocks
+        :param blocks:      bloom filter of each block of segment; filters are added for new blocks
+        :param data:        complete lines
+        :param first_line:  line number of first line of data within its segment
+        """
+        k = self.index_interval
+        bits = self.trigram_bits
+        nbytes = bits // 8
+        seen = set()  # trigrams already added to the current block
+        for i, line in enumerate(self._decode(data)[:-1], first_line):
+            if len(blocks) <= i // k or i % k == 0:
+                seen.clear()
+            while len(blocks) <= i // k:
+                blocks.append(bytearray(nbytes))
+            bloom = blocks[i // k]
+            grams = self._trigrams(self._fold(line))
+            grams -= seen
+            seen |= grams
+            for gram in grams:
+                # same bits as _trigram_bits, inlined as this runs for every trigram appended
+                h = zlib.crc32(gram.encode("utf-8"))
+                pos = h % bits
+                bloom[pos >> 3] |= 1 << (pos & 7)
+                pos = (h >> 16) % bits
+                bloom[pos >> 3] |= 1 << (pos & 7)
+
+    @staticmethod
+    def _trigrams(text) -> set:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def _fold(text) -> str:
+        """Case fold text so that it contains a search string whenever re.IGNORECASE would find a match"""
+        # Python's re also matches dotted and dotless i with i, which casefold() does not
+        return text.casefold().replace("\u0131", "i").replace("\u0307", "")
+
+    def _finish_prepend(self):
+        """Finish rewriting the log if ChatLogWriter._prepend was stopped after moving the old log aside"""
+        old_path = self.path + ".prev"
+        if not os.path.isdir(old_path):
+            return
+        if not os.path.isdir(self.path):
+            # the new log is complete once the old one has been moved aside
+            new_path = self.path + ".new"
+            os.rename(new_path if os.path.isdir(new_path) else old_path, self.path)
+        if os.path.isdir(old_path):
+            shutil.rmtree(old_path)
+
+    def _migrate(self):
+        """Convert a single file log from older versions into the first segment"""
+        if os.path.isfile(self.path):
+            old = self.path + ".old"
+            os.rename(self.path, old)
+            os.mkdir(self.path)
+            os.rename(old, os.path.join(self.path, self.segment_format.format(0)))
+
+
+class LineReader:
+    """ Async iterator over lines that are produced in lists
+
+    Used for chat log input so that commands can consume a log lazily; the next list of lines is only read once
+    the previous one has been used up. If loop is set, each list is produced in the loop's default executor.
+
+    Attributes
+    ----------
+    batches : iterator                    iterator of non-empty lists of lines
+    loop    : :class:`AbstractEventLoop`  event loop whose executor produces lists; None to produce them inline
+    """
+
+    __slots__ = ["batches", "loop", "lines", "pos"]
+
+    def __init__(self, batches, loop=None):
+        self.batches = iter(batches)
+        self.loop = loop
+        self.lines = []
+        self.pos = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.pos >= len(self.lines):
+            self.lines = await self._next_batch()
+            self.pos = 0
+            if not self.lines:
+                raise StopAsyncIteration
+        self.pos += 1
+        return self.lines[self.pos - 1]
+
+    @staticmethod
+    def numbered(batches, start=0):
+        """Generate lists of (line number, line) tuples from lists of lines"""
+        for batch in batches:
+            yield list(enumerate(batch, start))
+            start += len(batch)
+
+    async def read_all(self) -> list:
+        """Read all remaining lines into a list"""
+        lines = self.lines[self.pos:]
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                break
+            lines.extend(batch)
+        self.lines = []
+        self.pos = 0
+        return lines
+
+    async def _next_batch(self):
+        """Get next list of lines; None if there are no more"""
+        if self.loop is None:
+            return next(self.batches, None)
+        return await self.loop.run_in_executor(None, next, self.batches, None)
+
+
+class LinePipe(LineReader):
+    """ In-process pipe that streams lines from one GNU command to the next
+
+    The command reading the pipe is started as a task when the first lines are sent, and runs alongside the command
+    writing it. Lines are passed in lists through a bounded queue, so the writer waits whenever the reader falls
+    behind and no stage of a pipeline holds more than a few lists of lines at a time. Once the reader has finished,
+    e.g. after grep -m, the pipe is broken and the writer is told to stop.
+
+    Attributes
+    ----------
+    start      : callable       function that takes the pipe and returns a coroutine running the reading command
+    task       : :class:`Task`  task running the reading command; None until started
+    queue      : :class:`Queue` lists of lines waiting to be read, followed by None at the end of input
+    batch      : list           lines waiting to be put in the queue
+    batch_size : int            number of lines put in the queue at a time
+    number     : int            number of the next line if the reader wants (line number, line) tuples, else None
+    """
+
+    __slots__ = ["start", "task", "queue", "batch", "batch_size", "number"]
+
+    def __init__(self, start, batch_size=256, max_batches=8):
+        super().__init__(())
+        self.start = start
+        self.task = None
+        self.queue = asyncio.Queue(max_batches)
+        self.batch = []
+        self.batch_size = batch_size
+        self.number = None
+
+    @property
+    def broken(self) -> bool:
+        """True if the reading command has finished"""
+        return self.task is not None and self.task.done()
+
+    async def send(self, line: str) -> bool:
+        """Write line to pipe; returns False if pipe is broken and the writer should stop"""
+        if self.broken:
+            return False
+        self.batch.append(line)
+        if len(self.batch) >= self.batch_size:
+            await self._put()
+        return not self.broken
+
+    async def close(self):
+        """Write end of input, starting the reading command if needed, and wait for it to finish"""
+        if not self.broken:
+            await self._put()
+            await self.queue.put(None)
+        try:
+            await self.task
+        except Exception:
+            # already logged by _done
+            pass
+
+    def numbered(self):
+        """Read (line number, line) tuples instead of lines, starting from 0"""
+        self.number = 0
+        return self
+
+    async def _put(self):
+        """Start reading command if needed, and put waiting lines in the queue"""
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.start(self))
+            self.task.add_done_callback(self._done)
+        if self.batch:
+            await self.queue.put(self.batch)
+            self.batch = []
+
+    def _done(self, task):
+        """Log errors of reading command, and unblock a writer waiting for space in the queue"""
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Error in piped command", exc_info=task.exception())
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    async def _next_batch(self):
+        """Get next list of lines; None if there are no more"""
+        if self.batch is None:
+            return None
+        batch = await self.queue.get()
+        if batch is None:
+            # keep returning None at the end of input
+            self.batch = None
+        elif self.number is not None:
+            batch = list(enumerate(batch, self.number))
+            self.number += len(batch)
+        return batch
+
+
+class ChatLogWriter:
+    """ Write-behind writer for chat logs
+
+    Lines are queued in memory and written to disk by a background task that keeps one open file handle per
+    channel. The queue is flushed every flush_interval seconds, or sooner if more than flush_bytes are waiting.
+
+    Attributes
+    ----------
+    loop           : :class:`AbstractEventLoop`  event loop used for the background task and executor
+    base_dir       : str                         directory containing chat logs
+    segment_size   : int                         size of each chat log segment
+    flush_interval : float                       max number of seconds a line stays in the queue
+    flush_bytes    : int                         number of queued bytes that triggers an early flush
+    fsync          : str                         none  - leave syncing to the OS
+                                                 flush - fsync every file written by a flush
+                                                 close - fsync only when a file is closed
+    """
+
+    fsync_policies = ("none", "flush", "close")
+
+    def __init__(self, loop, base_dir, segment_size, flush_interval=1.0, flush_bytes=65536, fsync="none"):
+        self.loop = loop
+        self.base_dir = base_dir
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.fsync = fsync
+
+        # queued lines {(sid, cid): [bytes, ...]} and the config of each log when it was last queued
+        self.pending = {}
+        self.configs = {}
+        self.pending_bytes = 0
+
+        # chat logs {(sid, cid): ChatLog}
+        self.logs = {}
+
+        # batch handed to the executor by flush() or prepend() and not yet written; it is emptied once written
+        self.writing = None
+        self.closed = False
+
+        # flush_lock keeps flushes in order; lock guards logs and chat logs between the loop and executor threads
+        self.flush_lock = asyncio.Lock()
+        self.lock = threading.RLock()
+        self.wakeup = asyncio.Event()
+        self.task = loop.create_task(self._run())
+
+    def write(self, sid, cid, line, config):
+        """Queue line for channel log; does not block
+        :param config:  chat log config for channel
+        """
+        key = (sid, cid)
+        data = line.encode("utf-8")
+        if key not in self.pending:
+            self.pending[key] = []
+        self.pending[key].append(data)
+        self.configs[key] = config
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.flush_bytes:
+            self.wakeup.set()
+
+    def get_log(self, sid, cid) -> ChatLog:
+        """Get chat log for channel"""
+        key = (sid, cid)
+        with self.lock:
+            if key not in self.logs:
+                self.logs[key] = ChatLog(os.path.join(self.base_dir, sid, cid))
+            return self.logs[key]
+
+    async def flush(self):
+        """Write all queued lines to disk"""
+        async with self.flush_lock:
+            batch = self._take()
+            if batch:
+                self.writing = batch
+                try:
+                    await self.loop.run_in_executor(None, self._write, batch)
+                finally:
+                    self.writing = None
+
+    async def delete(self, sid, cid) -> bool:
+        """Drop queued lines and delete chat log for channel; returns False if log did not exist"""
+        async with self.flush_lock:
+            self.pending.pop((sid, cid), None)
+            with self.lock:
+                chat_log = self.get_log(sid, cid)
+                del self.logs[(sid, cid)]
+                return chat_log.delete()
+
+    async def prepend(self, sid, cid, data, config):
+        """Write lines before everything else in channel log, e.g. to import older history
+
+        Segments can only be appended to, so the log is rewritten: data and then the existing log are appended to
+        a new log, which replaces the old one. The size cap drops the oldest lines as usual.
+
+        :param data:    complete lines, oldest first
+        :param config:  chat log config for channel
+        """
+        async with self.flush_lock:
+            batch = self._take()
+            self.writing = batch
+            try:
+                await self.loop.run_in_executor(None, self._prepend, (sid, cid), data, config, batch)
+            finally:
+                self.writing = None
+
+    def close(self):
+        """Stop background task, write queued lines and close all files; blocks until done
+
+        A flush may still be running in the executor. Its batch is written first, unless the flush has already
+        written it, so that lines stay in order; the flush then finds its batch empty and leaves the files closed.
+        """
+        self.task.cancel()
+        with self.lock:
+            self.closed = True
+            if self.writing is not None:
+                self._write(self.writing)
+            self._write(self._take())
+            for chat_log in self.logs.values():
+                chat_log.close(self.fsync != "none")
+
+    async def _run(self):
+        """Background task that flushes the queue"""
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Error writing chat logs")
+
+    def _take(self):
+        """Remove and return everything in the queue"""
+        batch = {key: (lines, self.configs[key]) for key, lines in self.pending.items()}
+        self.pending = {}
+        self.pending_bytes = 0
+        return batch
+
+    def _write(self, batch):
+        """Append batch to chat logs and empty it; runs in executor"""
+        with self.lock:
+            for (sid, cid), (lines, config) in batch.items():
+                chat_log = self.get_log(sid, cid)
+                self._append(chat_log, b"".join(lines), config)
+                if self.closed:
+                    # lines queued by a flush after close()
+                    chat_log.close(self.fsync != "none")
+            batch.clear()
+
+    def _append(self, chat_log, data, config):
+        """Append data to chat log with the channel's config"""
+        chat_log.append(data, self.segment_size, config["max_size"], self.fsync != "none",
+                        config["grep_index"], config["compress"])
+        if self.fsync == "flush":
+            chat_log.sync()
+
+    def _prepend(self, key, data, config, batch):
+        """Write batch, then rewrite chat log with data first; runs in executor"""
+        self._write(batch)
+        with self.lock:
+            chat_log = self.get_log(*key)
+            new_path = chat_log.path + ".new"
+            if os.path.isdir(new_path):
+                shutil.rmtree(new_path)
+            new_log = ChatLog(new_path)
+            self._append(new_log, data, config)
+            for segment in chat_log.iter_raw():
+                self._append(new_log, segment, config)
+            new_log.close(self.fsync != "none")
+            # move the old log aside and only delete it once the new one is in place, so that a crash in between
+            # leaves a complete log, see ChatLog._finish_prepend
+            chat_log.close()
+            old_path = chat_log.path + ".prev"
+            if os.path.isdir(old_path):
+                shutil.rmtree(old_path)
+            os.rename(chat_log.path, old_path)
+            os.rename(new_path, chat_log.path)
+            shutil.rmtree(old_path)
+            del self.logs[key]
+
+
+class LogRecord:
+    """ Chat log entry for a single message or message edit
+
+    Holds only what is written to the chat log, so hooks do not need to keep or copy discord.py Message objects.
+    Records are written either in the classic text form or, for structured logging, as one JSON object per line:
+    {"ts": epoch, "kind": kind, "id": message id, "sid": sid, "cid": cid, "author": author id, "name": name,
+    "disc": discriminator, "content": content, "before": before}. "ts" always comes first so the line index can
+    find timestamps without parsing JSON.
+
+    Attributes
+    ----------
+    timestamp     : :class:`datetime`  time message was created (UTC)
+    mid           : str                message id
+    sid           : str                server id
+    cid           : str                channel id
+    author_id     : str                author id
+    name          : str                author name
+    discriminator : str                author discriminator
+    content       : str                message content; content after the edit for edits
+    kind          : str                "new" or "edit"
+    before        : str                content before the edit for edits, otherwise None
+    """
+
+    __slots__ = ["timestamp", "mid", "sid", "cid", "author_id", "name", "discriminator", "content", "kind", "before"]
+
+    def __init__(self, timestamp, mid, sid, cid, author_id, name, discriminator, content, kind="new", before=None):
+        self.timestamp = timestamp
+        self.mid = mid
+        self.sid = sid
+        self.cid = cid
+        self.author_id = author_id
+        self.name = name
+        self.discriminator = discriminator
+        self.content = content
+        self.kind = kind
+        self.before = before
+
+    @classmethod
+    def from_message(cls, message, kind="new", before=None):
+        """Create record from message
+        :param kind:    "new" or "edit"
+        :param before:  clean_content of the message before an edit
+        """
+        return cls(message.timestamp, message.id, message.server.id, message.channel.id, message.author.id,
+                   message.author.name, message.author.discriminator, message.clean_content, kind, before)
+
+    @classmethod
+    def from_json(cls, line: str):
+        """Create record from a JSON log line; None if line is not a record"""
+        try:
+            data = json.loads(line)
+            return cls(datetime.fromtimestamp(data["ts"], timezone.utc).replace(tzinfo=None), data["id"],
+                       data["sid"], data["cid"], data["author"], data["name"], data["disc"], data["content"],
+                       data["kind"], data.get("before"))
+        except (ValueError, TypeError, KeyError, OverflowError, OSError):
+            return None
+
+    def author(self) -> str:
+        """Author as name#discriminator"""
+        return "{0.name}#{0.discriminator}".format(self)
+
+    def text(self) -> str:
+        """Record in the classic text form, without line ending"""
+        timestamp = self.timestamp.replace(tzinfo=timezone.utc).astimezone(tz=None)
+        timestamp = str(timestamp)[:19]
+        content = self.content
+        if self.kind == "edit":
+            content = "EDIT:\nBefore: {}\nAfter: {}".format(self.before, self.content)
+        return "{0} @{1.name}#{1.discriminator}: {2}".format(timestamp, self, content)
+
+    def json(self) -> str:
+        """Record as a JSON object, without line ending"""
+        data = OrderedDict()
+        data["ts"] = round(self.timestamp.replace(tzinfo=timezone.utc).timestamp(), 3)
+        data["kind"] = self.kind
+        data["id"] = self.mid
+        data["sid"] = self.sid
+        data["cid"] = self.cid
+        data["author"] = self.author_id
+        data["name"] = self.name
+        data["disc"] = self.discriminator
+        data["content"] = self.content
+        if self.before is not None:
+            data["before"] = self.before
+        return json.dumps(data, ensure_ascii=False)
+
+
+class LogRule:
+    """ Frozen logging decision for a chat log channel
+
+    Built once from the channel config so that message_logger does not need to look at config or prefix settings
+    for every message.
+
+    Attributes
+    ----------
+    config   : dict   channel config passed on to the chat log writer
+    log_bot  : bool   True if messages from the bot are logged
+    prefixes : tuple  command prefixes of messages that are not logged; empty if commands are logged
+    """
+
+    __slots__ = ["config", "log_bot", "prefixes"]
+
+    def __init__(self, config, prefixes=()):
+        self.config = config
+        self.log_bot = config["log_bot"]
+        self.prefixes = () if config["log_commands"] else tuple(prefixes)
+
+    def allows(self, message, bot_user) -> bool:
+        """Check if message should be logged"""
+        if message.author == bot_user and not self.log_bot:
+            return False
+        # str.startswith accepts a tuple, so all prefixes are checked in one call
+        return not (self.prefixes and message.clean_content.startswith(self.prefixes))
+
+
+class CommandLine:
+    """ Parsed command line of a GNU command, and of the commands piped after it
+
+    Command lines are cached, so anything derived from one that does not depend on input, such as compiled regexes,
+    can be kept in compiled and reused the next time the same command line is run.
+
+    Attributes
+    ----------
+    name     : str        command name
+    option   : frozenset  single character options
+    values   : dict       values of options that take one {option: value}
+    operand  : str        first argument that is not an option, for commands that take one (grep pattern, sed script)
+    stdin    : str        remaining arguments joined with spaces
+    pipe     : tuple      arguments after the first '|', starting with the next command
+    redirect : dict       pastebin redirect, see GNU._get_redirect; None if output is not redirected
+    next     : :class:`CommandLine`  parsed command line of the next command in pipe; None if there is none
+    compiled : dict       values derived from the command line by the command {name: value}
+    """
+
+    __slots__ = ["name", "option", "values", "operand", "stdin", "pipe", "redirect", "next", "compiled"]
+
+    def __init__(self, name, option, values, operand, stdin, pipe, redirect, next_line=None):
+        self.name = name
+        self.option = option
+        self.values = values
+        self.operand = operand
+        self.stdin = stdin
+        self.pipe = pipe
+        self.redirect = redirect
+        self.next = next_line
+        self.compiled = {}
+
+    def stages(self) -> list:
+        """Command lines of the whole pipeline, starting with this one"""
+        stages = []
+        stage = self
+        while stage is not None:
+            stages.append(stage)
+            stage = stage.next
+        return stages
+
+
+class PatternCache:
+    """ Least recently used cache of compiled patterns
+
+    Commands compile the patterns they are given through pattern_cache, so that filters that are run again and
+    again, on different input or by different users, are only compiled once.
+
+    Attributes
+    ----------
+    size     : int                    max number of patterns
+    patterns : :class:`OrderedDict`   compiled patterns, least recently used first {key: pattern}
+    hits     : int                    number of lookups that found a compiled pattern
+    misses   : int                    number of lookups that compiled a pattern
+    """
+
+    __slots__ = ["size", "patterns", "hits", "misses"]
+
+    def __init__(self, size=256):
+        self.size = size
+        self.patterns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, source, flags=0):
+        """Compiled regex of a str or bytes source; raises re.error like re.compile"""
+        return self.get((source, flags), re.compile, source, flags)
+
+    def get(self, key, build, *args):
+        """Cached pattern of key; built with build(*args) and cached if it is not cached"""
+        pattern = self.patterns.get(key)
+        if pattern is not None:
+            self.hits += 1
+            self.patterns.move_to_end(key)
+            return pattern
+        self.misses += 1
+        pattern = self.patterns[key] = build(*args)
+        if len(self.patterns) > self.size:
+            self.patterns.popitem(last=False)
+        return pattern
+
+    def clear(self):
+        """Remove all patterns and reset counters"""
+        self.patterns.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+pattern_cache = PatternCache()
+
+
+class AhoCorasick:
+    """ Aho-Corasick automaton that finds any of a list of strings in a single pass over a line
+
+    Used by grep for lists of literal patterns (-e, -f), so the time taken to search a line does not depend on the
+    number of patterns. Empty patterns are ignored.
+
+    Attributes
+    ----------
+    ignore_case : bool   True if case is ignored
+    words       : bool   True if matches must form whole words
+    goto        : list   transitions of each state [{char: state}, ...]; state 0 is the start
+    fail        : list   state of the longest proper suffix of each state that is also a state
+    out         : list   lengths of the patterns that end at each state, including through fail; empty if none
+    """
+
+    __slots__ = ["ignore_case", "words", "goto", "fail", "out"]
+
+    def __init__(self, patterns, ignore_case=False, words=False):
+        self.ignore_case = ignore_case
+        self.words = words
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+
+        # build trie
+        for pattern in patterns:
+            if ignore_case:
+                pattern = pattern.lower()
+            if not pattern:
+                continue
+            state = 0
+            for c in pattern:
+                if c not in self.goto[state]:
+                    self.goto[state][c] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = self.goto[state][c]
+            self.out[state] = (len(pattern),)
+
+        # link each state to its longest suffix, breadth first so that shorter states are linked first
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and c not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(c, 0)
+                self.out[next_state] += self.out[self.fail[next_state]]
+
+    def search(self, line: str) -> bool:
+        """True if any pattern is found in line"""
+        if self.ignore_case:
+            line = line.lower()
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for i, c in enumerate(line):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if out[state]:
+                if not self.words:
+                    return True
+                for length in out[state]:
+                    if self._is_word(line, i + 1 - length, i + 1):
+                        return True
+        return False
+
+    @staticmethod
+    def _is_word(line: str, start: int, end: int) -> bool:
+        """True if line[start:end] is not preceded or followed by a word character"""
+        if start > 0 and (line[start - 1].isalnum() or line[start - 1] == '_'):
+            return False
+        if end < len(line) and (line[end].isalnum() or line[end] == '_'):
+            return False
+        return True
+
+
+class SedProgram:
+    """ Compiled sed program, run in one pass over the input
+
+    Commands are (first, last, command, text, search, replace, flags, occurrence) tuples. first is the address of
+    the command, or None if it applies to every line, and last is the address that ends a range, or None. Addresses
+    are ("line", number), ("last",) for $, ("step", first, step) or ("regex", compiled regex). text is the text of
+    a, c and i; search, replace and flags are the parts of s///, and occurrence is the number of the first match it
+    replaces; with the g flag, every match from that one on is replaced.
+
+    Running the program does not change it; the line number and which ranges are open are kept in a state tuple that
+    is passed from one list of lines to the next, so lists of lines can be run in a regex worker.
+
+    Attributes
+    ----------
+    commands : tuple  commands, run in order on each line
+    quiet    : bool   True if lines are only printed by commands (-n)
+    """
+
+    __slots__ = ["commands", "quiet"]
+
+    def __init__(self, commands, quiet=False):
+        self.commands = tuple(commands)
+        self.quiet = quiet
+
+    @property
+    def uses_regex(self) -> bool:
+        """True if running the program runs user supplied regexes"""
+        return any(command[2] == 's' or self._kind(command[0]) == "regex" or self._kind(command[1]) == "regex"
+                   for command in self.commands)
+
+    @property
+    def uses_last(self) -> bool:
+        """True if the program needs to know the number of lines in the input to match $"""
+        return any(self._kind(command[0]) == "last" or self._kind(command[1]) == "last" for command in self.commands)
+
+    def start(self, num_lines: int = None, line_offset: int = 0) -> tuple:
+        """ State before the first line
+        :param num_lines:    number of lines in input; None if unknown, in which case $ matches no line
+        :param line_offset:  number of lines skipped at the start of input
+        :return:             (number of the last line run, num_lines, tuple of whether each command's range is open)
+        """
+        return line_offset, num_lines, (False,) * len(self.commands)
+
+    def window(self, num_lines: int) -> tuple:
+        """Range of lines [start, stop) outside of which no command matches; stop is None for end of input"""
+        start = None
+        stop = 0
+        for first, last, command, text, search, replace, flags, occurrence in self.commands:
+            if self._kind(first) in (None, "regex") or self._kind(last) == "regex":
+                return 0, None
+            first_line = self._line(first, num_lines)
+            start = first_line if start is None else min(start, first_line)
+            if first[0] == "step" or (last is not None and last[0] == "step"):
+                stop = None
+            elif stop is not None:
+                stop = max(stop, first_line, self._line(last, num_lines) if last is not None else 0)
+        return max((start or 1) - 1, 0), stop
+
+    def run(self, lines, state: tuple) -> tuple:
+        """ Run program on lines
+        :return:  (list of lists of output lines, one list per input line, state after the last line)
+        """
+        line_num, num_lines, active = state
+        active = list(active)
+        results = []
+        for line in lines:
+            line_num += 1
+            output = []
+            appended = []
+            deleted = False
+            for k, (first, last, command, text, search, replace, flags, occurrence) in enumerate(self.commands):
+                # determine if match
+                if first is None:
+                    match = True
+                elif last is None:
+                    match = self._match(first, line, line_num, num_lines)
+                elif active[k]:
+                    match = True
+                    if last[0] == "line":
+                        active[k] = line_num < last[1]
+                    else:
+                        active[k] = not self._match(last, line, line_num, num_lines)
+                elif self._match(first, line, line_num, num_lines):
+                    # a range whose end is a line number that has been reached only matches this line
+                    match = True
+                    active[k] = not (last[0] == "line" and last[1] <= line_num
+                                     or last[0] == "last" and line_num == num_lines)
+                else:
+                    match = False
+                if not match:
+                    continue
+
+                # run command
+                if command == 'p':
+                    output.append(line)
+                elif command == '=':
+                    output.append(str(line_num))
+                elif command == 'i':
+                    output.append(text)
+                elif command == 'a':
+                    appended.append(text)
+                elif command == 's':
+                    if occurrence == 1:
+                        line, count = search.subn(replace, line, 0 if 'g' in flags else 1)
+                    else:
+                        line, count = self._substitute(search, replace, line, occurrence, 'g' in flags)
+                    if count and 'p' in flags:
+                        output.append(line)
+                elif command == 'd':
+                    deleted = True
+                    break
+                elif command == 'c':
+                    # change whole range to text once it ends
+                    deleted = True
+                    if last is None or not active[k]:
+                        output.append(text)
+                    break
+
+            # echo line
+            if not deleted and not self.quiet:
+                output.append(line)
+            output.extend(appended)
+            results.append(output)
+        return results, (line_num, num_lines, tuple(active))
+
+    @staticmethod
+    def _substitute(search, replace, line, occurrence, every) -> tuple:
+        """ Replace the match of search in line numbered occurrence, and every match after it if every is True
+        :return:  (line, number of matches replaced)
+        """
+        parts = []
+        end = 0
+        count = 0
+        for num, match in enumerate(search.finditer(line), 1):
+            if num < occurrence:
+                continue
+            parts.append(line[end:match.start()])
+            parts.append(match.expand(replace))
+            end = match.end()
+            count += 1
+            if not every:
+                break
+        if not count:
+            return line, 0
+        parts.append(line[end:])
+        return "".join(parts), count
+
+    @staticmethod
+    def _kind(address):
+        """Kind of address; None if there is none"""
+        return None if address is None else address[0]
+
+    @staticmethod
+    def _line(address: tuple, num_lines: int) -> int:
+        """First line number a line number address can match"""
+        if address[0] == "last":
+            return num_lines
+        return address[1]
+
+    @staticmethod
+    def _match(address: tuple, line: str, line_num: int, num_lines: int) -> bool:
+        """True if address matches line"""
+        if address[0] == "line":
+            return line_num == address[1]
+        elif address[0] == "last":
+            return line_num == num_lines
+        elif address[0] == "step":
+            if address[2] <= 0:
+                return line_num == address[1]
+            return line_num >= address[1] and (line_num - address[1]) % address[2] == 0
+        return address[1].search(line) is not None
+
+
+class RegexPool:
+    """ Worker processes that run user supplied regexes, so that a slow regex cannot block the bot
+
+    Jobs are run by regex_worker in a separate process, one list of lines at a time. Each command has a time budget
+    for its jobs; if the budget runs out while a job is running, the worker is killed and replaced by a new process
+    the next time one is needed. Idle workers are kept for reuse. Workers also let large inputs be searched on all
+    cores, by running several lists of lines at once.
+
+    Attributes
+    ----------
+    loop      : :class:`AbstractEventLoop`  event loop whose executor waits for workers
+    size      : int                         max number of workers; defaults to the number of cores
+    budget    : float                       number of seconds each command may spend running user supplied regexes
+    batch     : int                         default number of lines sent to a worker at a time
+    idle      : list                        idle workers [(process, connection), ...]
+    semaphore : :class:`Semaphore`          limits number of workers running jobs to size
+    """
+
+    __slots__ = ["loop", "size", "budget", "batch", "idle", "semaphore"]
+
+    def __init__(self, loop, size=None, budget=5.0, batch=512):
+        self.loop = loop
+        self.size = size or multiprocessing.cpu_count()
+        self.budget = budget
+        self.batch = batch
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(self.size)
+
+    def stream(self, items, job, key=None, timeout=None, batch=None, parallel=1, stateful=False):
+        """ Run job on lines of an async iterator
+        :param items:     async iterator of items
+        :param job:       job for regex_worker, see regex_worker
+        :param key:       function that gets the line from an item; None if items are lines
+        :param timeout:   number of seconds the job may run for in total; None for no limit
+        :param batch:     number of lines sent to a worker at a time; None for default
+        :param parallel:  number of lists of lines that may be run at once
+        :param stateful:  if True, the last item of job is a state that the worker replies with along with the results,
+                          and that is passed on with the next list of lines; parallel must be 1
+        :return:          :class:`RegexStream` of (item, result) tuples, in the order of items
+        """
+        return RegexStream(self, items, job, key, timeout, batch or self.batch, parallel, stateful)
+
+    async def run(self, job, lines: list, timeout: float = None) -> tuple:
+        """ Run job on lines in a worker
+        :return:  (list of results, one per line, or None if the job took longer than timeout and the worker was
+                   killed, number of seconds the job took)
+        """
+        async with self.semaphore:
+            worker = self.idle.pop() if self.idle else self._start()
+            try:
+                results, elapsed = await self.loop.run_in_executor(None, self._exchange, worker[1], (job, lines),
+                                                                   timeout)
+            except BaseException:
+                self._kill(worker)
+                raise
+            if results is None:
+                self._kill(worker)
+                return None, elapsed
+            self.idle.append(worker)
+        if isinstance(results, Exception):
+            raise results
+        return results, elapsed
+
+    def close(self):
+        """Kill all idle workers"""
+        while self.idle:
+            self._kill(self.idle.pop())
+
+    @staticmethod
+    def _exchange(conn, message, timeout: float) -> tuple:
+        """Send message to a worker and wait for its reply; (reply or None if there is none within timeout, seconds)"""
+        start = time.monotonic()
+        conn.send(message)
+        if not conn.poll(timeout):
+            return None, time.monotonic() - start
+        return conn.recv(), time.monotonic() - start
+
+    @staticmethod
+    def _start() -> tuple:
+        """Start a worker process"""
+        conn, worker_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=regex_worker, args=(worker_conn,), daemon=True)
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    @staticmethod
+    def _kill(worker: tuple):
+        """Stop a worker process"""
+        process, conn = worker
+        process.terminate()
+        conn.close()
+        process.join(1)
+
+
+def regex_worker(conn):
+    """ Run regex jobs from a RegexPool until the connection is closed
+
+    Each message is a (job, lines) tuple, and the reply is a list of results, one per line, or the exception raised
+    by the job. Jobs are:
+    ("search", (pattern, flags))  result is True if pattern matches the line
+    ("sed", SedProgram, state)    result is the list of output lines of the line; the reply is
+                                  (results, state after the last line), see SedProgram.run
+    """
+    patterns = PatternCache()
+    compiled = patterns.compile
+
+    while True:
+        try:
+            job, lines = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            if job[0] == "search":
+                search = compiled(*job[1]).search
+                results = [search(line) is not None for line in lines]
+            else:
+                results = job[1].run(lines, job[2])
+        except Exception as e:
+            results = e
+        conn.send(results)
+
+
+class RegexStream:
+    """ Async iterator that runs a RegexPool job on lines from another async iterator
+
+    Lines are read and sent to workers a list at a time, and (item, result) tuples are returned in order as each list
+    is done, so output is not held back until all input has been read. Up to parallel lists are run at once. If the
+    job runs out of time, iteration stops and timed_out is set.
+
+    Attributes
+    ----------
+    pool      : :class:`RegexPool`  pool that runs the job
+    items     : async iterator      input items
+    job       : tuple               job for regex_worker
+    key       : callable            function that gets the line from an item; None if items are lines
+    timeout   : float               number of seconds the job may run for in total; None for no limit
+    batch     : int                 number of lines sent to a worker at a time
+    parallel  : int                 number of lists of lines that may be run at once
+    stateful  : bool                True if the last item of job is a state that is passed from list to list
+    pending   : :class:`deque`      lists of items being run, in order [(items, future of results), ...]
+    used      : float               number of seconds spent running the job
+    results   : list                (item, result) tuples of the last list of lines
+    pos       : int                 position of the next tuple in results
+    done      : bool                True if all items have been read
+    timed_out : bool                True if the job ran out of time
+    """
+
+    __slots__ = ["pool", "items", "job", "key", "timeout", "batch", "parallel", "stateful", "pending", "used",
+                 "results", "pos", "done", "timed_out"]
+
+    def __init__(self, pool, items, job, key=None, timeout=None, batch=512, parallel=1, stateful=False):
+        self.pool = pool
+        self.items = items
+        self.job = job
+        self.key = key
+        self.timeout = timeout
+        self.batch = batch
+        self.parallel = 1 if stateful else parallel
+        self.stateful = stateful
+        self.pending = deque()
+        self.used = 0.0
+        self.results = []
+        self.pos = 0
+        self.done = False
+        self.timed_out = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.pos >= len(self.results):
+            self.results = await self._next_results()
+            self.pos = 0
+            if not self.results:
+                raise StopAsyncIteration
+        self.pos += 1
+        return self.results[self.pos - 1]
+
+    async def _next_results(self) -> list:
+        """Get (item, result) tuples of the next list of lines; empty if there are no more or the job ran out of time"""
+        while not self.done and not self.timed_out and len(self.pending) < self.parallel:
+            items = await self._read()
+            if items:
+                self.pending.append((items, asyncio.ensure_future(self._run(items))))
+        if self.timed_out or not self.pending:
+            return []
+        items, future = self.pending.popleft()
+        results = await future
+        if results is None:
+            self.timed_out = True
+            return []
+        return list(zip(items, results))
+
+    async def _read(self) -> list:
+        """Read the next list of items"""
+        items = []
+        while len(items) < self.batch:
+            try:
+                items.append(await self.items.__anext__())
+            except StopAsyncIteration:
+                self.done = True
+                break
+        return items
+
+    async def _run(self, items):
+        """Run job on a list of items; None if it ran out of time"""
+        lines = items if self.key is None else [self.key(item) for item in items]
+        timeout = None if self.timeout is None else max(self.timeout - self.used, 0.0)
+        results, elapsed = await self.pool.run(self.job, lines, timeout)
+        self.used += elapsed
+        if self.stateful and results is not None:
+            results, state = results
+            self.job = self.job[:-1] + (state,)
+        return results
+
+
+class LoopScheduler:
+    """ Shares the event loop between long running GNU command loops
+
+    Each command run reads its input through a TimeSlice, which yields to the event loop every lines lines or after
+    holding it for interval seconds, whichever comes first, so that heartbeats and other commands are not held up while a command
+    writes to a pipe or buffer. The time each command holds the loop is kept for the last few commands, and stretches
+    longer than warn seconds are logged.
+
+    Attributes
+    ----------
+    lines    : int              max number of lines between yields
+    interval : float            max number of seconds between yields
+    warn     : float            log stretches without a yield longer than this many seconds
+    history  : :class:`deque`   TimeSlices of recent commands, newest last
+    """
+
+    __slots__ = ["lines", "interval", "warn", "history"]
+
+    def __init__(self, lines=1000, interval=0.02, warn=0.1, history=100):
+        self.lines = lines
+        self.interval = interval
+        self.warn = warn
+        self.history = deque(maxlen=history)
+
+    def start(self, name: str, ctx, items):
+        """ Start timing a command run
+        :param name:   command name
+        :param ctx:    command context
+        :param items:  async iterator over the input of the command's loop
+        :return:       :class:`TimeSlice` over items
+        """
+        time_slice = TimeSlice(self, items, name, str(ctx.message.author))
+        self.history.append(time_slice)
+        return time_slice
+
+
+class TimeSlice:
+    """ Async iterator over the input of a single command run that shares the event loop, see LoopScheduler
+
+    The command's loop reads its input through this, which yields to the event loop before returning a line when one
+    is due. Time spent waiting for input, e.g. for a pipe or a regex worker, is not counted as holding the loop.
+    Neither is time the loop body spends waiting, e.g. for the send queue or a 'more' prompt: a callback is scheduled
+    whenever the command gets the loop back, and if it has run by the next line, the command let go of the loop when
+    it ran. Only the time up to then is counted for that line.
+
+    Attributes
+    ----------
+    scheduler : :class:`LoopScheduler`  scheduler that started this
+    items     : async iterator          input of the command
+    name      : str                     command name
+    author    : str                     author of command
+    started   : float                   time.monotonic() when the command started
+    resumed   : float                   time.monotonic() when the command last got the loop or an item back
+    held      : float                   number of seconds the command has held the loop since the last yield
+    count     : int                     number of lines since the last yield
+    lines     : int                     number of lines before the last yield
+    busy      : float                   number of seconds the command has held the loop
+    longest   : float                   longest number of seconds the command held the loop without a yield
+    yields    : int                     number of yields
+    finished  : float                   number of seconds the command ran for; None while running
+    armed     : bool                    True while a callback is scheduled to find out when the command lets go of
+                                        the loop
+    released  : float                   time.monotonic() when the command let go of the loop since it was resumed;
+                                        None if it has not
+    """
+
+    __slots__ = ["scheduler", "items", "name", "author", "started", "resumed", "held", "count", "lines", "busy",
+                 "longest", "yields", "finished", "armed", "released"]
+
+    def __init__(self, scheduler, items, name, author):
+        self.scheduler = scheduler
+        self.items = items
+        self.name = name
+        self.author = author
+        self.started = self.resumed = time.monotonic()
+        self.held = 0.0
+        self.count = 0
+        self.lines = 0
+        self.busy = 0.0
+        self.longest = 0.0
+        self.yields = 0
+        self.finished = None
+        self.armed = False
+        self.released = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self._hold()
+        self.count += 1
+        if self.count >= self.scheduler.lines or self.held >= self.scheduler.interval:
+            self._stop()
+            self.yields += 1
+            await asyncio.sleep(0)
+        try:
+            return await self.items.__anext__()
+        except StopAsyncIteration:
+            self.count -= 1
+            raise
+        finally:
+            self.resumed = time.monotonic()
+            self.released = None
+            if not self.armed:
+                self.armed = True
+                asyncio.get_event_loop().call_soon(self._release)
+
+    def finish(self):
+        """Stop timing the command"""
+        self._hold()
+        self._stop()
+        self.finished = time.monotonic() - self.started
+        log.debug("%s by %s: %d lines, %.3fs on the loop of %.3fs, longest %.3fs, %d yields", self.name,
+                  self.author, self.lines, self.busy, self.finished, self.longest, self.yields)
+
+    def _hold(self):
+        """Add time held since the command was resumed, up to when it let go of the loop if it did"""
+        self.held += (time.monotonic() if self.released is None else self.released) - self.resumed
+
+    def _release(self):
+        """Note that the command has let go of the loop"""
+        self.armed = False
+        self.released = time.monotonic()
+
+    def _stop(self):
+        """Add time held since the last yield"""
+        self.busy += self.held
+        self.longest = max(self.longest, self.held)
+        self.lines += self.count
+        self.count = 0
+        if self.held >= self.scheduler.warn:
+            log.warning("%s by %s held the event loop for %.3fs", self.name, self.author, self.held)
+        self.held = 0.0
+
+
+class OutputPacker:
+    """ Packs the output lines of a command into messages
+
+    Lines are kept until the next one would make the message too long, and the length of the kept lines is kept as
+    they are added, so packing a line takes the same time however many lines are already waiting. Lines that are too
+    long for a message on their own are split with split() first.
+
+    Attributes
+    ----------
+    limit  : int   max length of a message
+    lines  : list  lines waiting to be sent
+    length : int   length of lines waiting to be sent, each counted with the padding it was added with
+    """
+
+    __slots__ = ["limit", "lines", "length"]
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lines = []
+        self.length = 0
+
+    def add(self, line: str, pad: int = 1):
+        """ Add line to the message being packed
+        :param line:  line no longer than limit
+        :param pad:   length counted for line on top of its own, at least 1 for the line ending
+        :return:      the packed message if line did not fit in it and starts the next one; otherwise None
+        """
+        message = None
+        if self.lines and self.length + len(line) >= self.limit:
+            message = self.flush()
+        self.lines.append(line)
+        self.length += len(line) + pad
+        return message
+
+    def flush(self) -> str:
+        """Take the message being packed; empty if there are no lines waiting"""
+        message = "\n".join(self.lines)
+        self.lines = []
+        self.length = 0
+        return message
+
+    @staticmethod
+    def split(line: str, limit: int) -> list:
+        """ Split line into pieces no longer than limit
+        Pieces end after the last whitespace that leaves them at least half full, or are cut at limit if there is
+        none, so words are only broken when they are longer than half a message. Joining the pieces gives line.
+        """
+        pieces = []
+        start = 0
+        while len(line) - start > limit:
+            cut = start + limit
+            space = max(line.rfind(" ", start + limit // 2, cut), line.rfind("\t", start + limit // 2, cut))
+            if space != -1:
+                cut = space + 1
+            pieces.append(line[start:cut])
+            start = cut
+        pieces.append(line[start:])
+        return pieces
+
+
+class SendScheduler:
+    """ Paces the messages GNU commands send to each channel
+
+    Discord lets a bot send 5 messages per channel every 5 seconds and answers anything more with a 429 that has to
+    be retried. Messages are instead queued per channel and sent by a SendQueue task with a token bucket, in which
+    each of capacity tokens is spent on a message and comes back per seconds later. While the queued messages
+    already use up every token, new lines are joined onto the last queued message of the same author as long as it
+    fits, so output that outruns the bucket is sent in as few messages as possible.
+
+    Attributes
+    ----------
+    bot       : :class:`Bot`  bot that sends messages
+    limit     : int           max length of a message made by joining lines
+    capacity  : int           number of messages that may be sent in per seconds
+    per       : float         number of seconds after which a spent token comes back; a little over Discord's 5
+                              seconds so that network jitter does not trip its limit
+    max_depth : int           commands wait for the queue to get shorter before adding more than this many messages
+    queues    : dict          send queues of channels {channel id: SendQueue}
+    """
+
+    __slots__ = ["bot", "limit", "capacity", "per", "max_depth", "queues"]
+
+    def __init__(self, bot, limit, capacity=5, per=5.25, max_depth=5):
+        self.bot = bot
+        self.limit = limit
+        self.capacity = capacity
+        self.per = per
+        self.max_depth = max_depth
+        self.queues = {}
+
+    async def send(self, channel, author, text: str, comment: bool):
+        """ Queue message for channel, joining it onto the last queued one if the bucket is low
+        :param channel:  channel to send to
+        :param author:   author of command that sends message; only messages of the same author are joined
+        :param text:     message text, already escaped
+        :param comment:  send text in a comment block
+        """
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = SendQueue(self, channel)
+        await queue.put(author.id, text, comment)
+
+    async def drain(self, channel):
+        """Wait until all messages queued for channel have been sent"""
+        queue = self.queues.get(channel.id)
+        if queue is not None and queue.task is not None:
+            await asyncio.shield(queue.task)
+
+    def close(self):
+        """Stop sending queued messages"""
+        for queue in self.queues.values():
+            if queue.task is not None:
+                queue.task.cancel()
+        self.queues.clear()
+
+
+class SendQueue:
+    """ Messages waiting to be sent to a single channel, see SendScheduler
+
+    Attributes
+    ----------
+    scheduler : :class:`SendScheduler`  scheduler that owns this
+    channel   : :class:`Channel`        channel messages are sent to
+    messages  : :class:`deque`          queued messages, oldest first [[author id, comment, text, time queued], ...]
+    spent     : :class:`deque`          time.monotonic() of the last capacity messages sent, oldest first
+    task      : :class:`Task`           task sending queued messages; None while the queue is empty
+    waiters   : list                    futures of commands waiting for the queue to get shorter
+    sent      : int                     number of messages sent
+    joined    : int                     number of messages joined onto a queued one instead of being sent alone
+    waited    : float                   total number of seconds sent messages were queued
+    longest   : float                   longest number of seconds a sent message was queued
+    """
+
+    __slots__ = ["scheduler", "channel", "messages", "spent", "task", "waiters", "sent", "joined", "waited",
+                 "longest"]
+
+    def __init__(self, scheduler, channel):
+        self.scheduler = scheduler
+        self.channel = channel
+        self.messages = deque()
+        self.spent = deque(maxlen=scheduler.capacity)
+        self.task = None
+        self.waiters = []
+        self.sent = 0
+        self.joined = 0
+        self.waited = 0.0
+        self.longest = 0.0
+
+    def tokens(self) -> int:
+        """Number of messages that could be sent now"""
+        now = time.monotonic()
+        return self.scheduler.capacity - sum(1 for spent in self.spent if now - spent < self.scheduler.per)
+
+    def wait(self) -> float:
+        """Number of seconds the oldest queued message has been waiting"""
+        return time.monotonic() - self.messages[0][3] if self.messages else 0.0
+
+    async def put(self, author_id, text, comment):
+        """Queue message, joining it onto the last queued one if the queued ones already use up every token"""
+        while len(self.messages) >= self.scheduler.max_depth and self.task is not None:
+            waiter = asyncio.Future()
+            self.waiters.append(waiter)
+            await waiter
+        last = self.messages[-1] if self.messages else None
+        if (last is not None and last[0] == author_id and last[1] == comment
+                and len(self.messages) >= self.tokens() and len(last[2]) + 1 + len(text) <= self.scheduler.limit):
+            last[2] += "\n" + text
+            self.joined += 1
+        else:
+            self.messages.append([author_id, comment, text, time.monotonic()])
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        """Send queued messages as tokens come back"""
+        try:
+            while self.messages:
+                if len(self.spent) == self.scheduler.capacity:
+                    delay = self.spent[0] + self.scheduler.per - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                _, comment, text, queued = self.messages.popleft()
+                self._wake()
+                now = time.monotonic()
+                self.spent.append(now)
+                self.sent += 1
+                self.waited += now - queued
+                self.longest = max(self.longest, now - queued)
+                try:
+                    await self.scheduler.bot.send_message(self.channel, "```\n{0}\n```".format(text) if comment
+                                                          else text)
+                except Exception:
+                    log.error("Error sending GNU output", exc_info=True)
+        finally:
+            self.task = None
+            self._wake()
+
+    def _wake(self):
+        """Let commands waiting for the queue to get shorter go on"""
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = []
+
 
 class GNU:
     """Some unix-like utilities"""
@@ -26,10 +2242,41 @@ class GNU:
 
         # chat log config
         self.config = dataIO.load_json(self.config_path)
-        self.config_default = {"active": False, "max_size": 1048576, "log_bot": False, "log_commands": False}
+        self.config_default = {"active": False, "max_size": 1048576, "log_bot": False, "log_commands": False,
+                               "grep_index": False, "compress": False, "format": "text"}
+
+        # Chat logs are split into segments of this size; the oldest segment is dropped when a log exceeds max_size
+        self.segment_size = 1024 * 100
+
+        # write-behind chat log writer
+        self.writer_default = {"flush_interval": 1.0, "flush_bytes": 65536, "fsync": "none"}
+        writer_config = dict(self.writer_default, **self.config.get("log_writer", {}))
+        self.writer = ChatLogWriter(bot.loop, self.base_dir, self.segment_size, **writer_config)
+
+        # logging decisions {cid: LogRule or None if channel is not logged, ...}
+        self.log_rules = {}
+
+        # command prefixes {sid: (prefix, ...), ...}
+        self.prefixes = {}
+
+        # commands that change command prefixes; log_rules are rebuilt after these complete
+        self.prefix_commands = ("set prefix", "set serverprefix")
 
-        # Buffer when resizing log file to avoid too many resize operations
-        self.log_buffer = 1024 * 100
+        # clog backfill fetches this many messages per request, and waits this many seconds between requests
+        self.backfill_page = 100
+        self.backfill_interval = 1.0
+
+        # user supplied regexes (grep -r, sed) run in worker processes, and each command may spend this many seconds
+        # running them before it is stopped
+        self.regex_pool = RegexPool(bot.loop, budget=5.0)
+
+        # long command loops share the event loop through this
+        self.scheduler = LoopScheduler()
+
+        # grep -r searches inputs of at least this many lines on all workers at once, this many lines at a time, if
+        # there is more than one CPU
+        self.grep_parallel_lines = 50000
+        self.grep_chunk_lines = 5000
 
         # bot will pause and ask user for input after this number of messages have been sent to channel
         self.more_limit = 4
@@ -40,9 +2287,24 @@ class GNU:
         # max character length of a single message
         self.max_message_length = 1900
 
+        # command output is sent to each channel at Discord's rate limit through this
+        self.sender = SendScheduler(bot, self.max_message_length)
+
         # using a dict in case command and function are different; key = cmd, value = func
         self.command_list = {"grep": "grep", "wc": "wc", "tail": "tail", "cat": "cat", "tac": "tac", "sed": "sed"}
 
+        # how each command's arguments are parsed; key = cmd, value = (options that take a value, takes an operand,
+        # options that take the operand's place; these may be given more than once and their values are kept in a tuple)
+        self.command_args = {"grep": ("mABCef", True, "ef"), "wc": ("", False, ""), "tail": ("n", False, ""),
+                             "cat": ("", False, ""), "tac": ("s", False, ""), "sed": ("e", True, "e")}
+
+        # most recently used command lines {(cmd, args): CommandLine}
+        self.command_lines = OrderedDict()
+        self.command_lines_size = 256
+
+        # used to match chat log input, e.g. @chat or @chat[since=2h]
+        self.chat_pattern = re.compile(r"^@chat(?:\[(.*)\])?$", re.IGNORECASE | re.DOTALL)
+
         # used to match url input
         self.url_pattern = re.compile(
             r"^(?:http|ftp)s?://"  # http:// or https://
@@ -52,13 +2314,14 @@ class GNU:
             r"(?::\d+)?"  # optional port
             r"(?:/?|[/?]\S+)$", re.IGNORECASE)
 
-        # buffered output {author:[lines], ...}
-        self.buffer = {}
+        # buffered output of each running command {ctx: OutputPacker, ...}; piped commands have contexts of their own
+        self.buffer = weakref.WeakKeyDictionary()
 
         self.help_options = (
             "\n\t-p       If input is a URL, this will treat the URL content as (prettified) html instead of a DOM."
             "\n\t-@       Same as -p except source is not passed through BeautifulSoup's prettify()."
-            "\n\t-%       Print each line as a separate message; more likely to hit Discord's 5/5 rate limit.")
+            "\n\t-%       Print each line as a separate message while Discord's 5/5 rate limit allows;"
+            "\n\t         lines that queue up behind the limit are joined.")
 
         self.help_input = (
             "\n\nInput"
@@ -67,9 +2330,20 @@ class GNU:
             "\n\t         Unless -p or -@ options are set."
             "\n\t@chat    If '@chat' is specified as the input, chat log will be used as input."
             "\n\t         Logging must be activated in the channel for this to work."
+            "\n\t@chat[since=2h]  Only use chat log lines from the last 2 hours (s, m, h, d or w)."
+            "\n\t@chat[from=2018-04-01 12:00,to=2018-04-01 13:00]"
+            "\n\t         Only use chat log lines from a time range; either end may be left out."
+            "\n\t@chat[author=123,kind=edit]"
+            "\n\t         Only use messages from an author (id or name#discriminator) or of a kind (new or edit)."
+            "\n\t         Only works for messages logged after `clog format json`; selectors may be combined."
             "\n\t<input>  If none of the previous inputs are detected, remaining text is treated as input."
             "\n\t         To preserve whitespace (including newlines), enclose entire input in quotes.")
 
+    def __unload(self):
+        self.writer.close()
+        self.regex_pool.close()
+        self.sender.close()
+
     async def _get_url(self, url: str, fmt: str):
         """ Returns content from url resource
         :param url:    valid url string
@@ -110,6 +2384,61 @@ class GNU:
         else:
             return "Error: Unrecognized format"
 
+    def _command_line(self, cmd: str, args: tuple) -> CommandLine:
+        """ Parse arguments of a command, and of the commands piped after it
+        :param cmd:   command name
+        :param args:  arguments of command
+        :return:      CommandLine; a cached one if the same command line has been parsed recently
+        """
+        key = (cmd, tuple(args))
+        if key in self.command_lines:
+            self.command_lines.move_to_end(key)
+            return self.command_lines[key]
+
+        values, takes_operand, operand_values = self.command_args[cmd]
+        stdin = []
+        option = set()
+        option_values = {}
+        operand = ""
+        pipe = ()
+        iterator = iter(args)
+        for arg in iterator:
+            if arg == '|':
+                pipe = tuple(iterator)
+            elif arg[:1] == '-':
+                option.add(arg[1:])
+                for opt in values:
+                    if opt in arg and opt in operand_values:
+                        option_values[opt] = option_values.get(opt, ()) + (next(iterator),)
+                    elif opt in arg:
+                        option_values[opt] = next(iterator)
+            elif takes_operand and not operand:
+                operand = arg
+            else:
+                stdin.append(arg)
+        self._split_option(option)
+        if operand and any(opt in option_values for opt in operand_values):
+            # there is no operand; the argument taken for it is the start of input
+            stdin.insert(0, operand)
+            operand = ""
+
+        # Only look for redirected stdout if there is no pipe
+        redirect = None if pipe else self._get_redirect(stdin)
+
+        # parse next command; like _pipe_out, allow it to start with a prefix
+        next_line = None
+        if pipe:
+            next_cmd = pipe[0] if pipe[0] in self.command_list else pipe[0][1:]
+            if next_cmd in self.command_list:
+                next_line = self._command_line(next_cmd, pipe[1:])
+
+        command_line = CommandLine(cmd, frozenset(option), option_values, operand, " ".join(stdin), pipe, redirect,
+                                   next_line)
+        self.command_lines[key] = command_line
+        if len(self.command_lines) > self.command_lines_size:
+            self.command_lines.popitem(last=False)
+        return command_line
+
     def _split_option(self, option: set):
         """Splits multi-character options into single characters"""
         for opt in list(option):
@@ -145,52 +2474,54 @@ class GNU:
 
         return None
 
-    async def _flush_buffer(self, count, author, comment, buffer, say):
+    async def _flush_buffer(self, count, ctx, comment, buffer, say):
         """Flush buffer
         :param count:     number of lines said so far by command
-        :param author:    author of command that invoked this
+        :param ctx:       context of command that invoked this
         :param comment:   say line in comment block; ignored if pipe_out is set
         :param buffer:    if true, flush buffer; otherwise, do nothing
         :param say:       if true, content in buffer is sent to chat; otherwise, content is discarded
         """
-        if buffer and author in self.buffer.keys() and self.buffer[author]:
+        if buffer and ctx in self.buffer and self.buffer[ctx].lines:
+            bufout = self.buffer[ctx].flush()
             if say:
-                bufout = "\n".join(self.buffer[author])
-                await self._say(bufout, count, author, comment, False)
-            self.buffer[author] = []
+                await self._say(bufout, count, ctx, comment, False)
         return
 
-    async def _say(self, line: str, count: int, author: int, comment: bool, buffer: bool, **kwargs) -> int:
+    async def _say(self, line: str, count: int, ctx, comment: bool, buffer: bool, **kwargs) -> int:
         """Say line in channel or to pipe
         :param line:      line to say
         :param count:     number of lines said so far by command
-        :param author:    author of command that invoked this
+        :param ctx:       context of command that invoked this
         :param comment:   say line in comment block; ignored if pipe_out is set
         :param buffer:    if true, output is buffered and flushed only when necessary
         :kwarg line_num:  if specified AND is NOT None, prepend line_num to line
         :kwarg num_width: used to determine line_num spacing; required if line_num is set
-        :kwarg pipe_out:  if specified AND is type list, append to pipe_out instead of saying to channel
+        :kwarg pipe_out:  if specified AND is type list or LinePipe, write to pipe_out instead of saying to channel
         :return:          number of lines said to channel; -1 if output stopped
         """
         lines_said = 0
         # handle pipe
-        if "pipe_out" in kwargs and isinstance(kwargs["pipe_out"], list):
+        if "pipe_out" in kwargs and isinstance(kwargs["pipe_out"], (list, LinePipe)):
             # build line
             if "line_num" in kwargs and kwargs["line_num"] is not None:
                 # preserve enough space for "...:"
                 if kwargs["num_width"] < 3:
                     kwargs["num_width"] = 3
                 line = "{0:>{width}}: {1}".format(kwargs["line_num"], line, width=kwargs["num_width"])
-            kwargs["pipe_out"].append(line)
+            if isinstance(kwargs["pipe_out"], list):
+                kwargs["pipe_out"].append(line)
+            elif not await kwargs["pipe_out"].send(line):
+                # next command has finished, so stop
+                return -1
             return lines_said
 
         # if line is too long, split into multiple lines
         if len(line) > self.max_message_length:
-            for i in range(0, len(line), self.max_message_length):
+            for i, piece in enumerate(OutputPacker.split(line, self.max_message_length)):
                 if i > 0 and "line_num" in kwargs and kwargs["line_num"] is not None:
                     kwargs["line_num"] = "..."
-                result = await self._say(line[i:i + self.max_message_length], (count + lines_said), author, comment,
-                                         buffer, **kwargs)
+                result = await self._say(piece, (count + lines_said), ctx, comment, buffer, **kwargs)
                 if result == -1:
                     # user failed ro respond to flood protection
                     return result
@@ -205,51 +2536,57 @@ class GNU:
             line = "{0:>{width}}: {1}".format(kwargs["line_num"], line, width=kwargs["num_width"])
 
         # handle buffer
+        author = ctx.message.author
         if buffer:
             if "num_width" in kwargs:
                 pad = kwargs["num_width"] + 2
             else:
                 pad = 1
-            if author not in self.buffer.keys():
-                # empty buffer
-                self.buffer[author] = [line]
-                return 0
-            elif sum(len(s) + pad for s in self.buffer[author]) + len(line) < self.max_message_length:
+            if ctx not in self.buffer:
+                self.buffer[ctx] = OutputPacker(self.max_message_length)
+            bufout = self.buffer[ctx].add(line, pad)
+            if bufout is None:
                 # space available in buffer
-                self.buffer[author].append(line)
                 return 0
-            else:
-                # flush buffer and save line to emptied buffer
-                bufout = "\n".join(self.buffer[author])
-                self.buffer[author] = [line]
-                line = bufout
+            # say full buffer; line starts the emptied buffer
+            line = bufout
 
         # flood prevention
         if count > 0 and count % self.more_limit == 0:
-            await self.bot.say("Type 'more' or 'm' to continue...")
+            # prompts go through the channel's send queue too, so they count towards its rate limit
+            await self.sender.send(ctx.message.channel, author, "Type 'more' or 'm' to continue...", False)
+            await self.sender.drain(ctx.message.channel)
             answer = await self.bot.wait_for_message(timeout=self.response_timeout, author=author)
             if not answer or answer.content.lower() not in ["more", "m"]:
-                await self.bot.say("Output stopped.")
+                await self.sender.send(ctx.message.channel, author, "Output stopped.", False)
                 return -1
 
         # escape comment string
         line = line.replace("```", "\\`\\`\\`")
 
-        # say line
-        if comment:
-            await self.bot.say("```\n{0}\n```".format(line))
-        else:
-            await self.bot.say(line)
+        # say line; it is queued and sent when the channel's rate limit allows
+        await self.sender.send(ctx.message.channel, author, line, comment)
         return 1
 
-    async def _pipe(self, ctx, pipe, pipe_out, redirect):
-        """ Handle pipe and redirect
+    @staticmethod
+    async def _in_context(ctx, coro):
+        """ Run coroutine of a piped command in the context of the command line that invoked it
+
+        Piped commands run in tasks of their own. bot.say finds the channel to say to in the locals of its callers,
+        where discord.ext.commands sets them when it invokes a command, so they are set again here for the
+        prompts, usage and error messages the piped command says.
+        """
+        _internal_channel = ctx.message.channel
+        _internal_author = ctx.message.author
+        return await coro
+
+    def _pipe_out(self, ctx, pipe, redirect):
+        """ Output for a command
         :param ctx:       Context
         :param pipe:      Pipe args
-        :param pipe_out:  Piped output
         :param redirect:  Redirect setting
+        :return:          LinePipe to the next command if pipe exists; list if output is redirected; otherwise None
         """
-        # if pipe exists, invoke pipe
         if pipe:
             # get next command
             cmd = pipe[0]
@@ -258,20 +2595,36 @@ class GNU:
                 cmd = cmd[1:]
             # check if command is valid
             if cmd not in self.command_list.keys():
-                await self._say("{0}: command not found".format(cmd), 0, ctx.message.author, True, False)
-                return
+                return LinePipe(lambda pipe_in: self._in_context(
+                    ctx, self._say("{0}: command not found".format(cmd), 0, ctx, True, False)))
             # get function for command
             func = getattr(GNU, self.command_list[cmd])
-            # invoke command
-            if len(pipe) > 1:
-                await ctx.invoke(func, *pipe[1:], pipe_in="\n".join(pipe_out))
-            else:
-                await ctx.invoke(func, pipe_in="\n".join(pipe_out))
+            # the next command runs alongside this one, reading its output as it is written; it gets a context of
+            # its own, so its buffered output is kept apart from this command's
+            stage = copy.copy(ctx)
+            return LinePipe(lambda pipe_in: self._in_context(stage, stage.invoke(func, *pipe[1:], pipe_in=pipe_in)))
+        elif redirect:
+            return []
+        return None
+
+    async def _pipe(self, ctx, pipe, pipe_out, redirect):
+        """ Handle pipe and redirect
+        :param ctx:       Context
+        :param pipe:      Pipe args
+        :param pipe_out:  Piped output
+        :param redirect:  Redirect setting
+        """
+        # wait for output already queued for the channel, so that it comes before anything said after the command
+        await self.sender.drain(ctx.message.channel)
+
+        # if pipe exists, end its input and wait for the next command
+        if pipe:
+            await pipe_out.close()
             return
         elif redirect:
             # return if output is empty
             if not pipe_out:
-                await self._say("No output", 0, ctx.message.author, False, False)
+                await self._say("No output", 0, ctx, False, False)
                 return
             # post to pastebin
             data = {"api_dev_key": self.config["pastebin_api_key"],
@@ -285,16 +2638,19 @@ class GNU:
                     response_text = await response.text()
                     #response_text = response_text.replace("http://pastebin.com/", "http://pastebin.com/raw/")
                     await self._say("Output to pastebin with the following result: {0}".format(response_text),
-                                    0, ctx.message.author, False, False)
+                                    0, ctx, False, False)
             return
 
-    async def _get_chat(self, ctx):
-        """Get chat log"""
+    async def _get_chat_log(self, ctx, stdin: str):
+        """Get ChatLog for channel with all queued lines written, and the selector of chat log input
+        :param stdin:  chat log input, e.g. "@chat" or "@chat[since=2h]"
+        :return:       (ChatLog, selector); (None, None) if chat log is not available
+        """
 
         # ignore private channels
         if ctx.message.channel.is_private:
             await self.bot.say("Chat log not available for private channels.")
-            return None
+            return None, None
 
         cid = ctx.message.channel.id
         sid = ctx.message.server.id
@@ -303,16 +2659,90 @@ class GNU:
         if cid not in self.config or not self.config[cid]["active"]:
             await self.bot.say("Chat log does not appear to be enabled for this channel. "
                                "Type`{0}clog on` to enable chat log.".format(ctx.prefix))
-            return None
+            return None, None
+
+        # Parse selector
+        try:
+            selector = self._chat_selector(stdin)
+        except ValueError as e:
+            await self.bot.say(str(e))
+            return None, None
+
+        await self.writer.flush()
+        return self.writer.get_log(sid, cid), selector
+
+    def _chat_selector(self, stdin: str) -> dict:
+        """Parse selector of chat log input
+        :param stdin:  chat log input, e.g. "@chat", "@chat[since=2h]" or "@chat[from=2018-04-01,to=2018-04-02 12:00]"
+        :return:       {} for all lines; {"time_range": (since, until)} for lines in a time range, and
+                       {"fields": {"author": author, "kind": kind}} for structured log lines with matching fields
+        :raises ValueError: if selector is not valid
+        """
+        params = self.chat_pattern.match(stdin).group(1)
+        selector = {}
+        if not params:
+            return selector
+
+        since = ""
+        until = "\uffff"
+        fields = {}
+        for param in params.split(","):
+            key, sep, value = param.partition("=")
+            key = key.strip().lower()
+            value = value.strip()
+            if not sep:
+                raise ValueError("Expected key=value in chat selector: `{0}`".format(param))
+            if key == "since":
+                match = re.match(r"^(\d+)([smhdw])$", value.lower())
+                if not match:
+                    raise ValueError("Expected a duration like 30m, 2h or 7d: `{0}`".format(value))
+                units = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+                delta = timedelta(**{units[match.group(2)]: int(match.group(1))})
+                since = max(since, (datetime.now() - delta).strftime("%Y-%m-%d %H:%M:%S"))
+            elif key in ("from", "to"):
+                value = value.replace("T", " ")
+                if not re.match(r"^\d{4}(-\d\d(-\d\d( \d\d(:\d\d(:\d\d)?)?)?)?)?$", value):
+                    raise ValueError("Expected a time like 2018-04-01 or 2018-04-01 12:00: `{0}`".format(value))
+                # timestamps are compared as strings, so "to" includes everything that starts with it
+                if key == "from":
+                    since = max(since, value)
+                else:
+                    until = min(until, value + "\uffff")
+            elif key == "author":
+                # author id or name#discriminator
+                fields["author"] = value.lstrip("@")
+            elif key == "kind":
+                if value.lower() not in ("new", "edit"):
+                    raise ValueError("Expected kind=new or kind=edit: `{0}`".format(value))
+                fields["kind"] = value.lower()
+            else:
+                raise ValueError("Unknown chat selector: `{0}`".format(key))
+        if since or until != "\uffff":
+            selector["time_range"] = (since, until)
+        if fields:
+            selector["fields"] = fields
+        return selector
+
+    def _chat_reader(self, chat_log, selector: dict, numbered=False) -> LineReader:
+        """Async iterator over lines of chat log chosen by selector
+        :param numbered:  if true, iterate over (line number, line) tuples instead of lines
+        """
+        if selector:
+            batches = chat_log.iter_select(time_range=selector.get("time_range"), numbered=numbered,
+                                           fields=selector.get("fields"))
+        elif numbered:
+            batches = LineReader.numbered(chat_log.iter_lines())
+        else:
+            batches = chat_log.iter_lines()
+        return LineReader(batches, self.bot.loop)
 
-        # Get log
-        log = ""
-        file = os.path.join(self.base_dir, sid, cid)
-        if not os.path.isfile(file):
-            return log
-        with open(file, encoding="utf-8", mode='r') as f:
-            log = f.read()
-        return log
+    async def _get_chat(self, ctx, stdin: str):
+        """Get chat log as a single string"""
+        chat_log, selector = await self._get_chat_log(ctx, stdin)
+        if chat_log is None:
+            return None
+        lines = await self._chat_reader(chat_log, selector).read_all()
+        return "".join(line + "\n" for line in lines)
 
     @commands.command(pass_context=True, name='pastebin')
     @checks.is_owner()
@@ -334,6 +2764,111 @@ class GNU:
         await self.bot.say("Pastebin API key saved.")
         return
 
+    @commands.command(pass_context=True, name='clogwriter')
+    @checks.is_owner()
+    async def clogwriter(self, ctx, *args):
+        """Configure how chat logs are written to disk"""
+
+        # display help and current settings if args is empty
+        if not args:
+            await self.bot.say("*clogwriter* configures how chat logs are written to disk for all channels.")
+            await self.bot.say("```"
+                               "\nclogwriter interval [num]        Flush queued log lines at least every num seconds."
+                               "\nclogwriter size [num]            Flush early when num KiB of log lines are queued."
+                               "\nclogwriter fsync [none|flush|close]"
+                               "\n                                 none: leave syncing to the OS."
+                               "\n                                 flush: fsync log files after every flush."
+                               "\n                                 close: fsync log files only when they are closed."
+                               "```")
+            await self.bot.say("Interval: `{0.flush_interval}`, Size: `{1}`, Fsync: `{0.fsync}`".format(
+                self.writer, self._size(self.writer.flush_bytes)))
+            return
+
+        config = dict(self.writer_default, **self.config.get("log_writer", {}))
+        if args[0].lower() == "interval":
+            try:
+                interval = float(args[1])
+            except:
+                await self.bot.say("Please specify a number of seconds.")
+                return
+            if interval <= 0:
+                await self.bot.say("Interval must be greater than 0.")
+                return
+            config["flush_interval"] = self.writer.flush_interval = interval
+            await self.bot.say("Chat log flush interval set to `{0}` seconds.".format(interval))
+        elif args[0].lower() == "size":
+            try:
+                size = int(args[1])
+            except:
+                await self.bot.say("Please specify an integer for size.")
+                return
+            if size < 1:
+                await self.bot.say("Minimum size is 1.")
+                return
+            config["flush_bytes"] = self.writer.flush_bytes = size * 1024
+            await self.bot.say("Chat log flush size set to `{0}`".format(self._size(size * 1024)))
+        elif args[0].lower() == "fsync":
+            if len(args) < 2 or args[1].lower() not in ChatLogWriter.fsync_policies:
+                await self.bot.say("Please specify 'none', 'flush' or 'close'.")
+                return
+            config["fsync"] = self.writer.fsync = args[1].lower()
+            await self.bot.say("Chat log fsync policy set to `{0}`.".format(self.writer.fsync))
+        else:
+            await self.bot.say("Unknown command")
+            return
+
+        self.config["log_writer"] = config
+        dataIO.save_json(self.config_path, self.config)
+
+    @commands.command(pass_context=True, name='gnustats')
+    @checks.is_owner()
+    async def gnustats(self, ctx, *args):
+        """Show GNU cache, loop time and send queue diagnostics"""
+
+        if args and args[0].lower() == "reset":
+            pattern_cache.clear()
+            self.command_lines.clear()
+            self.scheduler.history.clear()
+            for queue in self.sender.queues.values():
+                queue.sent = queue.joined = 0
+                queue.waited = queue.longest = 0.0
+            await self.bot.say("GNU caches, send counters and loop time history cleared.")
+            return
+        elif args:
+            await self.bot.say("*gnustats* shows cache, loop time and send queue diagnostics."
+                               "\n```gnustats reset    Clear caches, counters and loop time history.```")
+            return
+
+        lookups = pattern_cache.hits + pattern_cache.misses
+        await self.bot.say(
+            "Pattern cache: `{0}` of `{1}` patterns, `{2}` hits, `{3}` misses (`{4:.1f}%` hit rate)"
+            "\nCommand line cache: `{5}` of `{6}` command lines"
+            "\nRegex workers: `{7}` idle of `{8}`".format(
+                len(pattern_cache.patterns), pattern_cache.size, pattern_cache.hits, pattern_cache.misses,
+                100 * pattern_cache.hits / lookups if lookups else 0, len(self.command_lines),
+                self.command_lines_size, len(self.regex_pool.idle), self.regex_pool.size))
+
+        # loop time of recent commands, newest first
+        if self.scheduler.history:
+            lines = ["{0:<6}{1:<24}{2:>10}{3:>10}{4:>10}{5:>10}".format("cmd", "author", "lines", "loop s",
+                                                                      "longest s", "total s")]
+            for time_slice in list(self.scheduler.history)[:-11:-1]:
+                lines.append("{0.name:<6}{1:<24}{0.lines:>10}{0.busy:>10.3f}{0.longest:>10.3f}{2:>10}".format(
+                    time_slice, time_slice.author[:23],
+                    "running" if time_slice.finished is None else "{0:.3f}".format(time_slice.finished)))
+            await self.bot.say("```" + "\n".join(lines) + "```")
+
+        # output send queues, busiest first
+        if self.sender.queues:
+            lines = ["{0:<20}{1:>7}{2:>8}{3:>8}{4:>8}{5:>10}{6:>10}".format("channel", "queued", "tokens", "sent",
+                                                                           "joined", "wait s", "longest s")]
+            queues = sorted(self.sender.queues.values(), key=lambda queue: queue.sent + queue.joined, reverse=True)
+            for queue in queues[:10]:
+                lines.append("{0:<20}{1:>7}{2:>8}{3.sent:>8}{3.joined:>8}{4:>10.3f}{3.longest:>10.3f}".format(
+                    str(queue.channel)[:19], len(queue.messages), queue.tokens(), queue,
+                    queue.waited / queue.sent if queue.sent else 0))
+            await self.bot.say("```" + "\n".join(lines) + "```")
+
     @commands.command(pass_context=True, name='clog')
     @checks.admin_or_permissions()
     async def clog(self, ctx, *args, **kwargs):
@@ -347,6 +2882,11 @@ class GNU:
                                "\nclog size [num]         Set the maximum log size for current channel to num MiB."
                                "\nclog bot [on|off]       Set whether or not bot logs its own messages."
                                "\nclog commands [on|off]  Set whether or not bot logs bot commands "
+                               "\nclog index [on|off]     Set whether or not a trigram index is kept to speed up grep."
+                               "\nclog index rebuild      Rebuild trigram index from chat log."
+                               "\nclog compress [on|off]  Set whether or not older parts of the chat log are compressed."
+                               "\nclog format [text|json] Set whether messages are logged as text or as JSON objects."
+                               "\nclog backfill [num]     Import up to num messages from before the chat log started."
                                "\nclog status             Display log settings and status for current channel."
                                "\nclog delete             Delete all logs for current channel."
                                "```")
@@ -391,20 +2931,67 @@ class GNU:
             elif args[1].lower() == "off" or args[1].lower() == "false":
                 self._clog_set(cid, log_commands=False)
                 await self.bot.say("Bot command log disabled.")
+        elif args[0].lower() == "index":
+            if len(args) < 2 or args[1].lower() not in ("on", "true", "off", "false", "rebuild"):
+                await self.bot.say("Please specify 'on', 'off' or 'rebuild'.")
+            elif args[1].lower() == "on" or args[1].lower() == "true":
+                self._clog_set(cid, grep_index=True)
+                await self.bot.say("Grep index enabled.")
+            elif args[1].lower() == "off" or args[1].lower() == "false":
+                self._clog_set(cid, grep_index=False)
+                await self.bot.say("Grep index disabled.")
+            elif args[1].lower() == "rebuild":
+                await self.writer.flush()
+                chat_log = self.writer.get_log(sid, cid)
+                await self.bot.loop.run_in_executor(None, chat_log.rebuild_trigrams)
+                await self.bot.say("Grep index rebuilt, size: `{0}`".format(self._size(chat_log.trigram_size())))
+        elif args[0].lower() == "compress":
+            if len(args) < 2 or args[1].lower() not in ("on", "true", "off", "false"):
+                await self.bot.say("Please specify 'on' or 'off'.")
+            elif args[1].lower() == "on" or args[1].lower() == "true":
+                self._clog_set(cid, compress=True)
+                await self.bot.say("Chat log compression enabled.")
+            elif args[1].lower() == "off" or args[1].lower() == "false":
+                self._clog_set(cid, compress=False)
+                await self.bot.say("Chat log compression disabled.")
+        elif args[0].lower() == "format":
+            if len(args) < 2 or args[1].lower() not in ("text", "json"):
+                await self.bot.say("Please specify 'text' or 'json'.")
+            else:
+                self._clog_set(cid, format=args[1].lower())
+                await self.bot.say("Chat log format set to `{0}`.".format(args[1].lower()))
+        elif args[0].lower() == "backfill":
+            try:
+                num = int(args[1])
+            except:
+                await self.bot.say("Please specify an integer for the number of messages.")
+                return
+            if num < 1:
+                await self.bot.say("Minimum number of messages is 1.")
+                return
+            if not self._clog_get(cid)["active"]:
+                await self.bot.say("Chat log does not appear to be enabled for this channel. "
+                                   "Type`{0}clog on` to enable chat log.".format(ctx.prefix))
+                return
+            await self.bot.say("Fetching up to `{0}` messages...".format(num))
+            await self._clog_backfill(ctx, num)
         elif args[0].lower() == "status":
             if cid in self.config:
                 c = self._clog_get(cid)
+                await self.writer.flush()
                 # Get current log size:
-                file = os.path.join(self.base_dir, sid, cid)
-                try:
-                    size = self._size(os.path.getsize(file))
-                except:
-                    size = 0
+                chat_log = self.writer.get_log(sid, cid)
+                size = self._size(chat_log.size())
+                raw_size = self._size(await self.bot.loop.run_in_executor(None, chat_log.raw_size))
                 max_size = self._size(c["max_size"])
                 # Display status
                 await self.bot.say(
                     "Active: `{0[active]}`, Log bot: `{0[log_bot]}`, Log commands: `{0[log_commands]}`, "
-                    "Max size: `{1}`, Current size: `{2}`".format(c, max_size, size))
+                    "Max size: `{1}`, Current size: `{2}` (`{3}` uncompressed), Segments: `{4}` (`{5}` compressed), "
+                    "Compress: `{0[compress]}`, Grep index: `{0[grep_index]}`, Index size: `{6}`, "
+                    "Format: `{0[format]}`".format(
+                        c, max_size, size, raw_size, len(chat_log.segments), len(chat_log.compressed),
+                        self._size(chat_log.trigram_size())))
             else:
                 await self.bot.say("Chat log not setup for this channel.")
         elif args[0].lower() == "delete":
@@ -414,12 +3001,10 @@ class GNU:
             if not answer or answer.content.lower() not in ["yes", "y"]:
                 await self.bot.say("No action taken.")
                 return -1
-            # Delete file
-            file = os.path.join(self.base_dir, sid, cid)
-            try:
-                os.remove(file)
+            # Delete log
+            if await self.writer.delete(sid, cid):
                 await self.bot.say("Chat log deleted.")
-            except:
+            else:
                 await self.bot.say("Chat log not found.")
         else:
             await self.bot.say("Unknown command")
@@ -438,6 +3023,8 @@ class GNU:
                                "\n\t-w       Select only those lines containing matches that form whole words."
                                "\n\t-v       Invert the sense of matching, to select non-matching lines."
                                "\n\t-r       Treats search string as a regex pattern; other Matching Options are ignored."
+                               "\n\t-e pat   Use pat as a pattern; may be given more than once to match any of several patterns."
+                               "\n\t-f list  Use each line of list as a pattern; list is a URL, or text in quotes."
                                "\n\nOutput Options"
                                "\n\t-c       Suppress normal output; instead print a count of matching lines for each input file."
                                "\n\t-n       Prefix each line of output with its line number."
@@ -451,43 +3038,16 @@ class GNU:
             return
 
         # parse user command
-        search = ""
-        stdin = []
-        option = set()
+        plan = self._command_line("grep", args)
+        search = plan.operand
+        stdin = plan.stdin
+        option = plan.option
         option_num = {'m': 0, 'A': 0, 'B': 0, 'C': 0}
-        pipe = []
-        iterator = args.__iter__()
-        for arg in iterator:
-            if arg == '|':
-                while True:
-                    try:
-                        pipe.append(next(iterator))
-                    except:
-                        break
-            elif arg[0] == '-':
-                option.add(arg[1:])
-                if 'm' in arg:
-                    option_num['m'] = int(next(iterator))
-                if 'A' in arg:
-                    option_num['A'] = int(next(iterator))
-                if 'B' in arg:
-                    option_num['B'] = int(next(iterator))
-                if 'C' in arg:
-                    option_num['C'] = int(next(iterator))
-            elif not search:
-                search = arg
-            else:
-                stdin.append(arg)
-        self._split_option(option)
-
-        # Only look for redirected stdout if there is no pipe
-        if not pipe:
-            redirect = self._get_redirect(stdin)
-        else:
-            redirect = None
-
-        # Prepare stdin
-        stdin = " ".join(stdin)
+        for opt, value in plan.values.items():
+            if opt in option_num:
+                option_num[opt] = int(value)
+        pipe = plan.pipe
+        redirect = plan.redirect
 
         # set buffer flag
         if '%' in option:
@@ -496,36 +3056,49 @@ class GNU:
             buffer = True
 
         # set pipe_out
-        if pipe or redirect:
-            pipe_out = []
-        else:
-            pipe_out = None
+        pipe_out = self._pipe_out(ctx, pipe, redirect)
 
         # try pipe_in if input is empty
         if not stdin and "pipe_in" in kwargs:
             stdin = kwargs["pipe_in"]
 
+        # get patterns from -e and -f, one per line of each list
+        searches = list(plan.values.get('e', ()))
+        for pattern_list in plan.values.get('f', ()):
+            if self.url_pattern.match(pattern_list):
+                pattern_list = await self._get_url(pattern_list, "raw")
+            searches.extend(pattern for pattern in pattern_list.splitlines() if pattern)
+        if search:
+            searches.append(search)
+
         # check arguments
-        if not search or not stdin:
+        if not searches or not stdin:
             await self.bot.say("Usage: `" + ctx.prefix + "grep [options] [pattern] [input]`"
                                                          "\n\nType `" + ctx.prefix + "grep` for more information.")
             return
 
-        # prepare search regex
-        if 'r' in option:
-            search_pattern = re.compile(r"{0}".format(search))
-        else:
-            search = re.escape(search)
-            if 'w' in option:
-                search = "\\b" + search + "\\b"
-            if 'i' in option:
-                search_pattern = re.compile(r"{0}".format(search), re.IGNORECASE)
-            else:
-                search_pattern = re.compile(r"{0}".format(search))
-        # await self.bot.say("`re: " + str(search_pattern) + " - " + search + "`")
+        # prepare search regexes; they are compiled once per command line and list of patterns
+        searches = tuple(searches)
+        if plan.compiled.get("searches") != searches:
+            plan.compiled["patterns"] = self._grep_patterns(searches, option)
+            plan.compiled["searches"] = searches
+        search_pattern, bytes_pattern, literals = plan.compiled["patterns"]
 
         # parse input
-        if self.url_pattern.match(stdin):
+        context = 'A' in option or 'B' in option or 'C' in option
+        sandboxed = 'r' in option  # user supplied regexes run in a worker process with a time budget
+        # search every line on all workers; literals are faster to search here than to send to workers, and
+        # with one CPU workers cannot search faster than this process
+        parallel = False
+        may_parallel = sandboxed and (os.cpu_count() or 1) > 1
+        if isinstance(stdin, LinePipe):
+            # piped input; streamed unless the width of line numbers is needed
+            if 'n' in option:
+                stdin = await stdin.read_all()
+            else:
+                num_lines = 0
+                lines = stdin.numbered()
+        elif self.url_pattern.match(stdin):
             # url resource
             if 'p' in option:
                 stdin = await self._get_url(stdin, "pretty")
@@ -535,88 +3108,228 @@ class GNU:
                 stdin = stdin.splitlines()
             else:
                 stdin = await self._get_url(stdin, "visible")
-        elif stdin.lower() == "@chat":
-            # chat log
-            stdin = await self._get_chat(ctx)
-            if stdin is None:
+        elif self.chat_pattern.match(stdin):
+            # chat log; streamed, reading only lines that may match unless context is needed
+            chat_log, selector = await self._get_chat_log(ctx, stdin)
+            if chat_log is None:
                 return
-            stdin = stdin.splitlines()
+            num_lines = await self.bot.loop.run_in_executor(None, chat_log.line_count)
+            # literals long enough to use the trigram index, if it is kept
+            indexed = []
+            if self._clog_get(ctx.message.channel.id)["grep_index"]:
+                indexed = [literal for literal in literals if len(literal) >= 3]
+            if not context and bytes_pattern is not None and not selector:
+                # search raw log bytes and only decode lines around hits, skipping blocks without the literals
+                lines = LineReader(chat_log.iter_search(search_pattern, bytes_pattern, 'v' in option,
+                                                        literals=indexed), self.bot.loop)
+            elif not context and 'v' not in option and indexed:
+                # only read blocks that contain every trigram of the search string
+                lines = LineReader(chat_log.iter_select(indexed, selector.get("time_range"),
+                                                        fields=selector.get("fields")), self.bot.loop)
+            else:
+                lines = self._chat_reader(chat_log, selector, numbered=True)
+                parallel = may_parallel and num_lines >= self.grep_parallel_lines
         else:
             # user input
             stdin = stdin.splitlines()
+        if isinstance(stdin, list):
+            num_lines = len(stdin)
+            lines = LineReader([list(enumerate(stdin))])
+            parallel = may_parallel and num_lines >= self.grep_parallel_lines
 
         # do grep
         match_count = 0  # number of lines matched by search expression
         display_count = 0  # number of lines said to chat
-        display_nums = set()  # line numbers of lines that have been said
         line_num = None  # Important that this is set to None at start
-        num_width = len(str(len(stdin)))
-        for i, line in enumerate(stdin):
-            # look for match
-            match = search_pattern.search(line)
-            if 'v' in option and match:
-                continue
-            elif 'v' not in option and not match:
-                continue
-            # record match
-            match_count += 1
-            # suppress output if c option set
-            if 'c' in option:
-                continue
-            # display previous context if necessary
-            if 'B' in option or 'C' in option:
-                ib = (i - option_num['B'] - option_num['C']) if (i - option_num['B'] - option_num['C']) >= 0 else 0
-                for b, bline in enumerate(stdin[ib:i]):
-                    if (ib + b) not in display_nums:
-                        line_num = b + 1 if 'n' in option else None
-                        result = await self._say(bline, display_count, ctx.message.author, True, buffer,
-                                                 pipe_out=pipe_out, line_num=line_num, num_width=num_width)
-                        if result == -1:
-                            await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                            return
-                        display_count += result
-                        display_nums.add(ib + b)
-            # display line
-            line_num = i + 1 if 'n' in option else None
-            if i not in display_nums:
-                result = await self._say(line, display_count, ctx.message.author, True, buffer,
-                                         pipe_out=pipe_out, line_num=line_num, num_width=num_width)
-                if result == -1:
-                    await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                    return
-                display_count += result
-                display_nums.add(i)
-            # display additional context if necessary
-            if 'A' in option or 'C' in option:
-                ia = i + option_num['A'] + option_num['C'] + 1
-                for a, aline in enumerate(stdin[(i + 1):ia]):
-                    if (i + 1 + a) not in display_nums:
-                        line_num = a + 1 if 'n' in option else None
-                        result = await self._say(aline, display_count, ctx.message.author, True, buffer,
-                                                 pipe_out=pipe_out, line_num=line_num, num_width=num_width)
+        num_width = len(str(num_lines))
+        before = deque(maxlen=option_num['B'] + option_num['C'])  # (i, line) of leading context for the next match
+        after = 0  # number of lines of trailing context left to say
+        last_said = None  # number of the last line said; groups of lines that are not adjacent are separated by --
+        stopping = False  # m option limit reached, only trailing context is left to say
+        if sandboxed or parallel:
+            # matches come back in input order, so line numbers, counts, -m and context work as usual
+            job = ("search", (search_pattern.pattern, search_pattern.flags))
+            lines = self.regex_pool.stream(lines, job,
+                                           key=lambda item: item[1],
+                                           timeout=self.regex_pool.budget if sandboxed else None,
+                                           batch=self.grep_chunk_lines if parallel else None,
+                                           parallel=self.regex_pool.size if parallel else 1)
+        time_slice = self.scheduler.start("grep", ctx, lines)
+        try:
+            async for item in time_slice:
+                # look for match
+                if sandboxed or parallel:
+                    (i, line), match = item
+                else:
+                    i, line = item
+                    match = search_pattern.search(line)
+                selected = bool(match) != ('v' in option) and not stopping
+                if selected:
+                    # record match
+                    match_count += 1
+                    # suppress output if c option set
+                    if 'c' in option:
+                        continue
+                elif after:
+                    # trailing context
+                    after -= 1
+                else:
+                    # keep line in case it is leading context
+                    before.append((i, line))
+                    continue
+                # display leading context and line
+                said = list(before)
+                said.append((i, line))
+                before.clear()
+                for j, jline in said:
+                    if context and last_said is not None and j != last_said + 1:
+                        result = await self._say("--", display_count, ctx, True, buffer,
+                                                 pipe_out=pipe_out)
                         if result == -1:
-                            await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
+                            await self._flush_buffer(display_count, ctx, True, buffer, False)
                             return
                         display_count += result
-                        display_nums.add(i + 1 + a)
-            # stop if m option set and limit reached
-            if 'm' in option and match_count >= option_num['m']:
-                break
-
-        # output for c option
-        if 'c' in option:
-            result = await self._say(str(match_count), display_count, ctx.message.author, True,
+                    line_num = j + 1 if 'n' in option else None
+                    result = await self._say(jline, display_count, ctx, True, buffer,
+                                             pipe_out=pipe_out, line_num=line_num, num_width=num_width)
+                    if result == -1:
+                        await self._flush_buffer(display_count, ctx, True, buffer, False)
+                        return
+                    display_count += result
+                    last_said = j
+                if selected:
+                    after = option_num['A'] + option_num['C']
+                    # stop after trailing context if m option set and limit reached
+                    if 'm' in option and match_count >= option_num['m']:
+                        stopping = True
+                if stopping and not after:
+                    break
+        finally:
+            time_slice.finish()
+        timed_out = sandboxed and lines.timed_out
+
+        # output for c option; count is incomplete if pattern ran out of time
+        if 'c' in option and not timed_out:
+            result = await self._say(str(match_count), display_count, ctx, True, buffer,
                                      pipe_out=pipe_out, line_num=line_num, num_width=num_width)
             if result == -1:
-                await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
+                await self._flush_buffer(display_count, ctx, True, buffer, False)
                 return
 
         # flush buffer
-        await self._flush_buffer(display_count, ctx.message.author, True, buffer, True)
+        await self._flush_buffer(display_count, ctx, True, buffer, True)
+
+        # tell user if pattern ran out of time
+        if timed_out:
+            await self._say("grep: pattern took longer than {} seconds; output is incomplete."
+                            .format(self.regex_pool.budget), 0, ctx, False, False)
 
         # handle pipe
         await self._pipe(ctx, pipe, pipe_out, redirect)
 
+    def _grep_patterns(self, searches: tuple, option) -> tuple:
+        """ Compile grep search strings; a line matches if any of them matches
+        :return:  (search regex or AhoCorasick, bytes regex that matches the same lines or None,
+                   literals every match contains)
+        """
+        if 'r' in option:
+            if len(searches) > 1:
+                search = "|".join("(?:{0})".format(pattern) for pattern in searches)
+            else:
+                search = searches[0]
+            search_pattern = pattern_cache.compile(search)
+            literals = self._regex_literals(search_pattern)
+            # user supplied regexes only run sandboxed, never over raw log bytes
+            bytes_pattern = None
+        elif len(searches) > 1:
+            # any number of literals are found in one pass
+            args = (searches, 'i' in option, 'w' in option)
+            search_pattern = pattern_cache.get(args, AhoCorasick, *args)
+            literals = []
+            bytes_pattern = None
+        else:
+            search = searches[0]
+            literals = [search]
+            if 'w' in option or 'i' in option or "\n" in search:
+                bytes_pattern = None
+            else:
+                bytes_pattern = pattern_cache.compile(re.escape(search.encode("utf-8")))
+            search = re.escape(search)
+            if 'w' in option:
+                search = "\\b" + search + "\\b"
+            if 'i' in option:
+                search_pattern = pattern_cache.compile(search, re.IGNORECASE)
+            else:
+                search_pattern = pattern_cache.compile(search)
+        return search_pattern, bytes_pattern, literals
+
+    def _regex_literals(self, pattern) -> list:
+        """Strings that every match of a compiled regex must contain; may be empty if none are found"""
+        if pattern.flags & re.VERBOSE or '|' in pattern.pattern:
+            return []
+        literals = []
+        run = ""
+        source = pattern.pattern
+        i = 0
+        while i < len(source):
+            c = source[i]
+            if c == '\\' and i + 1 < len(source) and not source[i + 1].isalnum():
+                # escaped punctuation is a literal character
+                run += source[i + 1]
+                i += 2
+                continue
+            elif c == '\\' and source[i + 1:i + 2] in tuple("xuUN0123456789"):
+                # escape followed by a code point or group number
+                return []
+            elif c == '\\' or c in ".^$+":
+                # character class, anchor, or end of a required run
+                i += 2 if c == '\\' else 1
+            elif c in "*?{":
+                # previous character is optional
+                run = run[:-1]
+                if c == '{':
+                    i = source.find('}', i) + 1 or len(source)
+                else:
+                    i += 1
+            elif c == '[':
+                i = self._skip_class(source, i)
+            elif c == '(':
+                # skip groups; they may be optional or repeated
+                depth = 0
+                while i < len(source):
+                    if source[i] == '\\':
+                        i += 1
+                    elif source[i] == '[':
+                        i = self._skip_class(source, i) - 1
+                    elif source[i] == '(':
+                        depth += 1
+                    elif source[i] == ')':
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    i += 1
+                i += 1
+            else:
+                run += c
+                i += 1
+                continue
+            literals.append(run)
+            run = ""
+        literals.append(run)
+        return [literal for literal in literals if literal]
+
+    def _skip_class(self, source: str, i: int) -> int:
+        """Position after the regex character class that starts at source[i]"""
+        i += 1
+        # a ']' right after '[' or '[^' is part of the class
+        if source[i:i + 1] == '^':
+            i += 1
+        if source[i:i + 1] == ']':
+            i += 1
+        while i < len(source) and source[i] != ']':
+            i += 2 if source[i] == '\\' else 1
+        return i + 1
+
     @commands.command(pass_context=True, name='wc')
     async def wc(self, ctx, *args, **kwargs):
         """Count the number of characters, whitespace-separated words, and newlines"""
@@ -635,39 +3348,16 @@ class GNU:
             return
 
         # parse user command
-        stdin = []
-        option = set()
-        pipe = []
-        iterator = args.__iter__()
-        for arg in iterator:
-            if arg == '|':
-                while True:
-                    try:
-                        pipe.append(next(iterator))
-                    except:
-                        break
-            elif arg[0] == '-':
-                option.add(arg[1:])
-            else:
-                stdin.append(arg)
-        self._split_option(option)
-
-        # Only look for redirected stdout if there is no pipe
-        if not pipe:
-            redirect = self._get_redirect(stdin)
-        else:
-            redirect = None
-
-        # Prepare stdin
-        stdin = " ".join(stdin)
+        plan = self._command_line("wc", args)
+        stdin = plan.stdin
+        option = plan.option
+        pipe = plan.pipe
+        redirect = plan.redirect
 
         # No point in using buffer for wc
 
         # Set pipe_out
-        if pipe or redirect:
-            pipe_out = []
-        else:
-            pipe_out = None
+        pipe_out = self._pipe_out(ctx, pipe, redirect)
 
         # try pipe_in if input is empty
         if not stdin and "pipe_in" in kwargs:
@@ -680,7 +3370,11 @@ class GNU:
             return
 
         # parse input
-        if self.url_pattern.match(stdin):
+        counts = None
+        if isinstance(stdin, LinePipe):
+            # piped input; streamed
+            pass
+        elif self.url_pattern.match(stdin):
             # url resource
             if 'p' in option:
                 stdin = await self._get_url(stdin, "pretty")
@@ -689,19 +3383,37 @@ class GNU:
             else:
                 input_texts = await self._get_url(stdin, "visible")
                 stdin = "\n".join([line for line in input_texts])
-        elif stdin.lower() == "@chat":
+        elif self.chat_pattern.match(stdin):
             # chat log
-            stdin = await self._get_chat(ctx)
-            if stdin is None:
+            chat_log, selector = await self._get_chat_log(ctx, stdin)
+            if chat_log is None:
                 return
+            if not selector:
+                # whole log; use the counts kept by the log
+                counts = await self.bot.loop.run_in_executor(None, chat_log.counts)
+            else:
+                stdin = self._chat_reader(chat_log, selector)
         else:
             # user input
             pass
 
         # get counts
-        lines = len(stdin.splitlines())
-        words = len(stdin.split())
-        chars = len(stdin)
+        if counts is not None:
+            lines, words, chars = counts
+        elif isinstance(stdin, str):
+            lines = len(stdin.splitlines())
+            words = len(stdin.split())
+            chars = len(stdin)
+        else:
+            # count streamed input one line at a time. Chat log lines all end with a newline, as in the log itself;
+            # piped lines are joined with newlines, so the last one has none, as with direct input
+            lines = words = chars = 0
+            async for line in stdin:
+                lines += line.count("\n") + 1
+                words += len(line.split())
+                chars += len(line) + 1
+            if lines and isinstance(stdin, LinePipe):
+                chars -= 1
 
         # output
         header = ""
@@ -722,10 +3434,11 @@ class GNU:
             data = "{0:<10}{1:<10}{2:<10}".format(chars, words, lines)
 
         if pipe or redirect:
-            pipe_out = [header, hr, data]
+            for line in (header, hr, data):
+                await self._say(line, 0, ctx, True, False, pipe_out=pipe_out)
         else:
             line = "\n".join([header, hr, data])
-            await self._say(line, 0, ctx.message.author, True, False)
+            await self._say(line, 0, ctx, True, False)
 
         # handle pipe
         await self._pipe(ctx, pipe, pipe_out, redirect)
@@ -746,34 +3459,12 @@ class GNU:
             return
 
         # parse user command
-        stdin = []
-        option = set()
-        option_num = ""
-        pipe = []
-        iterator = args.__iter__()
-        for arg in iterator:
-            if arg == '|':
-                while True:
-                    try:
-                        pipe.append(next(iterator))
-                    except:
-                        break
-            elif arg[0] == '-':
-                option.add(arg[1:])
-                if 'n' in arg:
-                    option_num = next(iterator)
-            else:
-                stdin.append(arg)
-        self._split_option(option)
-
-        # Only look for redirected stdout if there is no pipe
-        if not pipe:
-            redirect = self._get_redirect(stdin)
-        else:
-            redirect = None
-
-        # Prepare stdin
-        stdin = " ".join(stdin)
+        plan = self._command_line("tail", args)
+        stdin = plan.stdin
+        option = plan.option
+        option_num = plan.values.get('n', "")
+        pipe = plan.pipe
+        redirect = plan.redirect
 
         # Set buffer flag
         if '%' in option:
@@ -782,10 +3473,7 @@ class GNU:
             buffer = True
 
         # Set pipe_out
-        if pipe or redirect:
-            pipe_out = []
-        else:
-            pipe_out = None
+        pipe_out = self._pipe_out(ctx, pipe, redirect)
 
         # try pipe_in if input is empty
         if not stdin and "pipe_in" in kwargs:
@@ -798,7 +3486,18 @@ class GNU:
             return
 
         # parse input
-        if self.url_pattern.match(stdin):
+        pos = None  # position of first line to print
+        if isinstance(stdin, LinePipe):
+            # piped input; only keep the lines that will be printed
+            if option_num and option_num[0] == '+':
+                stdin = await stdin.read_all()
+            else:
+                last = deque(maxlen=max(int(option_num) if option_num else 10, 0))
+                async for line in stdin:
+                    last.append(line)
+                stdin = list(last)
+                pos = 0
+        elif self.url_pattern.match(stdin):
             # url resource
             if 'p' in option:
                 stdin = await self._get_url(stdin, "pretty")
@@ -808,43 +3507,60 @@ class GNU:
                 stdin = stdin.splitlines()
             else:
                 stdin = await self._get_url(stdin, "visible")
-        elif stdin.lower() == "@chat":
-            # chat log
-            stdin = await self._get_chat(ctx)
-            if stdin is None:
+        elif self.chat_pattern.match(stdin):
+            # chat log; read only the lines that will be printed
+            chat_log, selector = await self._get_chat_log(ctx, stdin)
+            if chat_log is None:
                 return
-            stdin = stdin.splitlines()
+            if selector:
+                stdin = await self._chat_reader(chat_log, selector).read_all()
+            elif option_num and option_num[0] == '+':
+                stdin = await self.bot.loop.run_in_executor(None, chat_log.read_lines, int(option_num[1:]) - 1)
+            else:
+                num = int(option_num) if option_num else 10
+                stdin = await self.bot.loop.run_in_executor(None, chat_log.read_last_lines, num)
+            if not selector:
+                pos = 0
         else:
             # user input
             stdin = stdin.splitlines()
 
         # determine range
-        if option_num:
-            if option_num[0] == '+':
-                pos = int(option_num[1:]) - 1
-            else:
-                pos = len(stdin) - int(option_num)
-        else:
-            pos = len(stdin) - 10
-        if pos < 0:
-            pos = 0
+        if pos is None:
+            pos = self._tail_pos(option_num, len(stdin))
 
         # do tail
         display_count = 0
         for line in stdin[pos:]:
-            result = await self._say(line, display_count, ctx.message.author, True, buffer,
+            result = await self._say(line, display_count, ctx, True, buffer,
                                      pipe_out=pipe_out)
             if result == -1:
-                await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
+                await self._flush_buffer(display_count, ctx, True, buffer, False)
                 return
             display_count += result
 
         # flush buffer
-        await self._flush_buffer(display_count, ctx.message.author, True, buffer, True)
+        await self._flush_buffer(display_count, ctx, True, buffer, True)
 
         # handle pipe
         await self._pipe(ctx, pipe, pipe_out, redirect)
 
+    def _tail_pos(self, option_num: str, num_lines: int) -> int:
+        """Position of first line printed by tail
+        :param option_num:  value of -n option, e.g. "5" or "+5"; empty for default
+        :param num_lines:   number of lines in input
+        """
+        if option_num:
+            if option_num[0] == '+':
+                pos = int(option_num[1:]) - 1
+            else:
+                pos = num_lines - int(option_num)
+        else:
+            pos = num_lines - 10
+        if pos < 0:
+            pos = 0
+        return pos
+
     @commands.command(pass_context=True, name='cat')
     async def cat(self, ctx, *args, **kwargs):
         """Echoes input to output"""
@@ -862,31 +3578,11 @@ class GNU:
             return
 
         # parse user command
-        stdin = []
-        option = set()
-        pipe = []
-        iterator = args.__iter__()
-        for arg in iterator:
-            if arg == '|':
-                while True:
-                    try:
-                        pipe.append(next(iterator))
-                    except:
-                        break
-            elif arg[0] == '-':
-                option.add(arg[1:])
-            else:
-                stdin.append(arg)
-        self._split_option(option)
-
-        # Only look for redirected stdout if there is no pipe
-        if not pipe:
-            redirect = self._get_redirect(stdin)
-        else:
-            redirect = None
-
-        # Prepare stdin
-        stdin = " ".join(stdin)
+        plan = self._command_line("cat", args)
+        stdin = plan.stdin
+        option = plan.option
+        pipe = plan.pipe
+        redirect = plan.redirect
 
         # Set buffer flag
         if '%' in option:
@@ -895,10 +3591,7 @@ class GNU:
             buffer = True
 
         # Set pipe_out
-        if pipe or redirect:
-            pipe_out = []
-        else:
-            pipe_out = None
+        pipe_out = self._pipe_out(ctx, pipe, redirect)
 
         # try pipe_in if input is empty
         if not stdin and "pipe_in" in kwargs:
@@ -911,7 +3604,13 @@ class GNU:
             return
 
         # parse input
-        if self.url_pattern.match(stdin):
+        if isinstance(stdin, LinePipe):
+            # piped input; streamed unless the width of line numbers is needed
+            if 'b' in option or 'n' in option:
+                stdin = await stdin.read_all()
+            else:
+                num_lines = 0
+        elif self.url_pattern.match(stdin):
             # url resource
             if 'p' in option:
                 stdin = await self._get_url(stdin, "pretty")
@@ -921,15 +3620,19 @@ class GNU:
                 stdin = stdin.splitlines()
             else:
                 stdin = await self._get_url(stdin, "visible")
-        elif stdin.lower() == "@chat":
+        elif self.chat_pattern.match(stdin):
             # chat log
-            stdin = await self._get_chat(ctx)
-            if stdin is None:
+            chat_log, selector = await self._get_chat_log(ctx, stdin)
+            if chat_log is None:
                 return
-            stdin = stdin.splitlines()
+            num_lines = await self.bot.loop.run_in_executor(None, chat_log.line_count)
+            stdin = self._chat_reader(chat_log, selector)
         else:
             # user input
             stdin = stdin.splitlines()
+        if isinstance(stdin, list):
+            num_lines = len(stdin)
+            stdin = LineReader([stdin])
 
         # do cat
         line_b = 0  # line number for 'b' option
@@ -937,35 +3640,39 @@ class GNU:
         display_count = 0  # number of lines said to chat
         prev_empty = False  # keep track of previous line for 's' option
         line_num = None  # Important that this is set to None at start
-        num_width = len(str(len(stdin)))
-        for line in stdin:
-            # skip line if 's' is set, previous line was empty, and this line is empty
-            if 's' in option and prev_empty and not line.strip():
-                continue
-            # increment line counters
-            line_n += 1
-            if line.strip():
-                line_b += 1
-            # set line number
-            if 'b' in option and line.strip():
-                line_num = line_b
-            elif 'n' in option:
-                line_num = line_n
-            # do output
-            result = await self._say(line, display_count, ctx.message.author, True, buffer,
-                                     pipe_out=pipe_out, line_num=line_num, num_width=num_width)
-            if result == -1:
-                await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                return
-            display_count += result
-            # set prev_empty
-            if not line.strip():
-                prev_empty = True
-            else:
-                prev_empty = False
+        num_width = len(str(num_lines))
+        time_slice = self.scheduler.start("cat", ctx, stdin)
+        try:
+            async for line in time_slice:
+                # skip line if 's' is set, previous line was empty, and this line is empty
+                if 's' in option and prev_empty and not line.strip():
+                    continue
+                # increment line counters
+                line_n += 1
+                if line.strip():
+                    line_b += 1
+                # set line number
+                if 'b' in option and line.strip():
+                    line_num = line_b
+                elif 'n' in option:
+                    line_num = line_n
+                # do output
+                result = await self._say(line, display_count, ctx, True, buffer,
+                                         pipe_out=pipe_out, line_num=line_num, num_width=num_width)
+                if result == -1:
+                    await self._flush_buffer(display_count, ctx, True, buffer, False)
+                    return
+                display_count += result
+                # set prev_empty
+                if not line.strip():
+                    prev_empty = True
+                else:
+                    prev_empty = False
+        finally:
+            time_slice.finish()
 
         # flush buffer
-        await self._flush_buffer(display_count, ctx.message.author, True, buffer, True)
+        await self._flush_buffer(display_count, ctx, True, buffer, True)
 
         # handle pipe
         await self._pipe(ctx, pipe, pipe_out, redirect)
@@ -986,34 +3693,12 @@ class GNU:
             return
 
         # parse user command
-        stdin = []
-        option = set()
-        option_sep = ""
-        pipe = []
-        iterator = args.__iter__()
-        for arg in iterator:
-            if arg == '|':
-                while True:
-                    try:
-                        pipe.append(next(iterator))
-                    except:
-                        break
-            elif arg[0] == '-':
-                option.add(arg[1:])
-                if 's' in arg:
-                    option_sep = next(iterator)
-            else:
-                stdin.append(arg)
-        self._split_option(option)
-
-        # Only look for redirected stdout if there is no pipe
-        if not pipe:
-            redirect = self._get_redirect(stdin)
-        else:
-            redirect = None
-
-        # Prepare stdin
-        stdin = " ".join(stdin)
+        plan = self._command_line("tac", args)
+        stdin = plan.stdin
+        option = plan.option
+        option_sep = plan.values.get('s', "")
+        pipe = plan.pipe
+        redirect = plan.redirect
 
         # Set buffer flag
         if '%' in option:
@@ -1022,10 +3707,7 @@ class GNU:
             buffer = True
 
         # Set pipe_out
-        if pipe or redirect:
-            pipe_out = []
-        else:
-            pipe_out = None
+        pipe_out = self._pipe_out(ctx, pipe, redirect)
 
         # try pipe_in if input is empty
         if not stdin and "pipe_in" in kwargs:
@@ -1038,7 +3720,14 @@ class GNU:
             return
 
         # parse input
-        if self.url_pattern.match(stdin):
+        if isinstance(stdin, LinePipe):
+            # piped input; all of it is needed to reverse it
+            stdin = await stdin.read_all()
+            if option_sep:
+                stdin = "\n".join(stdin)
+            else:
+                stdin = LineReader([stdin[::-1]])
+        elif self.url_pattern.match(stdin):
             # url resource
             if 'p' in option:
                 stdin = await self._get_url(stdin, "pretty")
@@ -1047,37 +3736,53 @@ class GNU:
             else:
                 input_texts = await self._get_url(stdin, "visible")
                 stdin = "\n".join([line for line in input_texts])
-        elif stdin.lower() == "@chat":
-            # chat log
-            stdin = await self._get_chat(ctx)
-            if stdin is None:
-                return
+        elif self.chat_pattern.match(stdin):
+            # chat log; streamed backwards from the end unless a separator is set
+            if option_sep:
+                stdin = await self._get_chat(ctx, stdin)
+                if stdin is None:
+                    return
+            else:
+                chat_log, selector = await self._get_chat_log(ctx, stdin)
+                if chat_log is None:
+                    return
+                if selector:
+                    stdin = await self._chat_reader(chat_log, selector).read_all()
+                    stdin = LineReader([stdin[::-1]])
+                else:
+                    stdin = LineReader(chat_log.iter_lines_reversed(), self.bot.loop)
         else:
             # user input
             pass
 
         # split input
-        if option_sep:
-            if 'r' in option:
-                separator = re.compile(r"{0}".format(option_sep))
-                stdin = separator.split(stdin)
+        if isinstance(stdin, str):
+            if option_sep:
+                if 'r' in option:
+                    separator = pattern_cache.compile(option_sep)
+                    stdin = separator.split(stdin)
+                else:
+                    stdin = stdin.split(option_sep)
             else:
-                stdin = stdin.split(option_sep)
-        else:
-            stdin = stdin.splitlines()
+                stdin = stdin.splitlines()
+            stdin = LineReader([stdin[::-1]])
 
         # do cat (on reversed string)
         display_count = 0
-        for line in reversed(stdin):
-            result = await self._say(line, display_count, ctx.message.author, True, buffer,
-                                     pipe_out=pipe_out)
-            if result == -1:
-                await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                return
-            display_count += result
+        time_slice = self.scheduler.start("tac", ctx, stdin)
+        try:
+            async for line in time_slice:
+                result = await self._say(line, display_count, ctx, True, buffer,
+                                         pipe_out=pipe_out)
+                if result == -1:
+                    await self._flush_buffer(display_count, ctx, True, buffer, False)
+                    return
+                display_count += result
+        finally:
+            time_slice.finish()
 
         # flush buffer
-        await self._flush_buffer(display_count, ctx.message.author, True, buffer, True)
+        await self._flush_buffer(display_count, ctx, True, buffer, True)
 
         # handle pipe
         await self._pipe(ctx, pipe, pipe_out, redirect)
@@ -1092,15 +3797,20 @@ class GNU:
                                "\nOptions"
                                "\n\t-g       Process entire input as a single string, rather than line by line."
                                "\n\t-n       Disable automatic printing; only produce output when explicitly told to."
+                               "\n\t-e script  Add script to the commands to run; may be given more than once."
                                + self.help_options +
+                               "\n\nScript"
+                               "\n\tA script is one or more commands separated by ';' or new lines, each with an optional"
+                               "\n\taddress. Every command is run in order on each line, in a single pass over the input."
                                "\n\nScript Address"
-                               "\n\t/.../    Returns lines that match the regular expression."
+                               "\n\t/.../    Returns lines that match the regular expression; /.../I ignores case."
                                "\n\tA        Returns line number A."
-                               "\n\tA,B      Returns lines from A to B."
+                               "\n\t$        Returns the last line."
+                               "\n\tA,B      Returns lines from A to B; B may also be a regular expression, e.g. /a/,/b/."
                                "\n\tA~N      Returns every Nth line, starting from A"
                                "\n\nScript Command"
-                               "\n\ta...     Append after each line."
-                               "\n\tc...     Change lines with new line."
+                               "\n\ta...     Append after each line; text runs to the end of the line."
+                               "\n\tc...     Change lines with new line; a range is changed to a single line."
                                "\n\td        Delete lines."
                                "\n\ti...     Insert before each line."
                                "\n\tp        Print line."
@@ -1109,39 +3819,19 @@ class GNU:
                                "\n\nScript Pattern Flag"
                                "\n\t/i       Ignore case"
                                "\n\t/p       Print (mostly used when -n option is active)"
+                               "\n\t/g       Replace every match, instead of only the first"
+                               "\n\t/N       Replace only the Nth match; with /g, every match from the Nth on"
                                + self.help_input +
                                "```")
             return
 
-        # parse input
-        option = set()
-        script = ""
-        stdin = []
-        pipe = []
-        iterator = args.__iter__()
-        for arg in iterator:
-            if arg == '|':
-                while True:
-                    try:
-                        pipe.append(next(iterator))
-                    except:
-                        break
-            elif arg[0] == '-':
-                option.add(arg[1:])
-            elif not script:
-                script = arg
-            else:
-                stdin.append(arg)
-        self._split_option(option)
-
-        # Only look for redirected stdout if there is no pipe
-        if not pipe:
-            redirect = self._get_redirect(stdin)
-        else:
-            redirect = None
-
-        # Prepare stdin
-        stdin = " ".join(stdin)
+        # parse user command
+        plan = self._command_line("sed", args)
+        script = "\n".join(plan.values.get('e', ()) + ((plan.operand,) if plan.operand else ()))
+        stdin = plan.stdin
+        option = plan.option
+        pipe = plan.pipe
+        redirect = plan.redirect
 
         # Set buffer flag
         if '%' in option:
@@ -1150,10 +3840,7 @@ class GNU:
             buffer = True
 
         # Set pipe_out
-        if pipe or redirect:
-            pipe_out = []
-        else:
-            pipe_out = None
+        pipe_out = self._pipe_out(ctx, pipe, redirect)
 
         # try pipe_in if input is empty
         if not stdin and "pipe_in" in kwargs:
@@ -1171,107 +3858,29 @@ class GNU:
                                                            "\n\nType `" + ctx.prefix + "sed` for more information.")
             return
 
-        # get address
-        address_type = ""
-        address = ""
-        if script[0] == '/':
-            address_type = "regex"
-            match = re.compile(r"^/(.*?)/(?<!\\/)i?", re.IGNORECASE).match(script)
-            # get regex for address range
+        # parse script; it is compiled once per command line
+        if "program" not in plan.compiled:
             try:
-                if match.group(0)[-1].lower() == 'i':
-                    address = re.compile(r"{0}".format(match.group(1)), re.IGNORECASE)
-                else:
-                    address = re.compile(r"{0}".format(match.group(1)))
-            except:
-                await self._say("Error trying to create substitution pattern: `{0}`".format(match.group(1)), 0,
-                                ctx.message.author, False, False)
+                commands = self._sed_script(script)
+            except ValueError as e:
+                await self.bot.say(str(e))
                 return
-            # shift script
-            script = script[match.end():]
-        elif re.compile(r"^[$\d]").match(script):
-            match = re.compile(r"^[$\d]+[,~]?[$\d]*").match(script)
-            # get tuple for address range
-            if ',' in match.group(0):
-                address_type = "range"
-                address = [match.group(0)[:match.group(0).index(',')], match.group(0)[match.group(0).index(',') + 1:]]
-            elif '~' in match.group(0):
-                address_type = "step"
-                address = [match.group(0)[:match.group(0).index('~')], match.group(0)[match.group(0).index('~') + 1:]]
-            else:
-                address_type = "line"
-                address = match.group(0)
-            # shift script
-            script = script[match.end():]
-        else:
-            address_type = "blank"
-            address = "all"
-
-        # check script again
-        if not script:
+            plan.compiled["program"] = SedProgram(commands, 'n' in option) if commands else None
+        program = plan.compiled["program"]
+        if program is None:
             await self.bot.say("Script command not found."
                                "\nUsage: `" + ctx.prefix + "sed [options] [script] [input]`"
                                "\n\nType `" + ctx.prefix + "sed` for more information.")
             return
 
-        # get command
-        sed_commands = {'a', 'c', 'd', 'i', 'p', 's', '='}
-        script = script.strip()
-        command = script[0]
-        if command not in sed_commands:
-            await self._say("Unknown command: `{0}`".format(command), 0, ctx.message.author, False, False)
-            return
-
-        if command in ('a', 'c', 'i', 's'):
-            if len(script) < 2:
-                await self._say("Expected characters after: `{0}`".format(command), 0, ctx.message.author, False, False)
-                return
-            acis_line = script[1:]
-        elif command == 'd':
-            if len(script) > 1:
-                await self._say("Extra characters after command: `{0}`".format(command), 0, ctx.message.author, False,
-                                False)
-                return
-        elif command == 'p':
-            if len(script) > 1:
-                await self._say("Extra characters after command: `{0}`".format(command), 0, ctx.message.author, False,
-                                False)
-                return
-
-        if command == 's':
-            if acis_line[0] != '/' or acis_line.count('/') < 3:
-                await self._say("Unknown substitution pattern: `{0}`".format(command), 0, ctx.message.author, False,
-                                False)
-                return
-            sub = re.compile(r"^(.*?)/(?<!\\/)(.*?)/(?<!\\/)(.*)").match(acis_line[1:])
-            if len(sub.groups()) != 3:
-                await self._say("Unknown substitution pattern: `{0}`".format(command), 0, ctx.message.author, False,
-                                False)
-                return
-            if sub.groups()[2].lower() not in ("i", "p", ""):
-                await self._say("Unrecognized pattern flag: `{0}`".format(command), 0, ctx.message.author, False, False)
-                return
-            sub_flag = sub.groups()[2].lower()
-            sub_replace = sub.groups()[1]
-            try:
-                if sub_flag.lower() == 'i':
-                    sub_search = re.compile(sub.groups()[0], re.IGNORECASE)
-                else:
-                    sub_search = re.compile(sub.groups()[0], re.IGNORECASE)
-            except:
-                await self._say("Error trying to create substitution pattern: `{0}`".format(command), 0,
-                                ctx.message.author, False, False)
-                return
-        elif command == '=':
-            if len(script) > 1:
-                await self._say("Extra characters after command: `{0}`".format(command), 0, ctx.message.author, False,
-                                False)
-                return
-
-        # await self.bot.say("command: " + command)
-
         # parse input
-        if self.url_pattern.match(stdin):
+        if isinstance(stdin, LinePipe):
+            # piped input; streamed unless it is processed as a single string or '$' needs the number of lines
+            if 'g' in option:
+                stdin = ["\n".join(await stdin.read_all())]
+            elif program.uses_last:
+                stdin = await stdin.read_all()
+        elif self.url_pattern.match(stdin):
             # url resource
             if 'p' in option:
                 stdin = await self._get_url(stdin, "pretty")
@@ -1290,15 +3899,17 @@ class GNU:
                 if 'g' in option:
                     input_string = "\n".join([line for line in stdin])
                     stdin = [input_string]
-        elif stdin.lower() == "@chat":
-            # chat log
-            stdin = await self._get_chat(ctx)
-            if stdin is None:
+        elif self.chat_pattern.match(stdin):
+            # chat log; lines are read after the number of lines is known, unless only some lines are selected
+            chat_log, selector = await self._get_chat_log(ctx, stdin)
+            if chat_log is None:
                 return
-            if 'g' in option:
-                stdin = [stdin]
+            if not selector:
+                stdin = None
             else:
-                stdin = stdin.splitlines()
+                stdin = await self._chat_reader(chat_log, selector).read_all()
+                if 'g' in option:
+                    stdin = ["\n".join(stdin)]
         else:
             # user input
             if 'g' in option:
@@ -1306,198 +3917,286 @@ class GNU:
             else:
                 stdin = stdin.splitlines()
 
-        # fix up address
-        if address_type in ("range", "step"):
-            if address[0] == '$':
-                address[0] = len(stdin)
-            else:
-                address[0] = int(address[0])
-            if address[1] == '$':
-                address[1] = len(stdin)
-            else:
-                address[1] = int(address[1])
-        elif address_type == "line":
-            if address == '$':
-                address = len(stdin)
+        # get number of lines in input
+        if isinstance(stdin, LinePipe):
+            # only needed for '$', in which case input has been read into a list
+            num_lines = None
+        elif stdin is not None:
+            num_lines = len(stdin)
+        elif 'g' in option:
+            num_lines = 1
+        else:
+            num_lines = await self.bot.loop.run_in_executor(None, chat_log.line_count)
+
+        # stream chat log; if only matched lines are printed, read only the lines the addresses can match
+        line_offset = 0  # number of lines skipped at the start of input
+        if stdin is None:
+            if 'n' in option and 'g' not in option:
+                line_offset, line_stop = program.window(num_lines)
             else:
-                address = int(address)
-        if (address_type == "range") and (address[0] >= address[1]):
-            address_type = "line"
-            address = address[0]
+                line_stop = None
+            stdin = LineReader(chat_log.iter_lines(line_offset, line_stop), self.bot.loop)
+            if 'g' in option:
+                stdin = LineReader([["\n".join(await stdin.read_all())]])
+        elif not isinstance(stdin, LinePipe):
+            stdin = LineReader([stdin])
+
+        # programs with user supplied regexes run in a worker process
+        state = program.start(num_lines, line_offset)
+        sandboxed = program.uses_regex
+        if sandboxed:
+            stdin = self.regex_pool.stream(stdin, ("sed", program, state), timeout=self.regex_pool.budget,
+                                           stateful=True)
 
         # do sed
         display_count = 0
-        sub_match = False
-        for i, line in enumerate(stdin):
-            line_num = i + 1
-            # determine if match
-            match = False
-            if address_type == "blank":
-                match = True
-            elif address_type == "range":
-                if line_num >= address[0] and line_num <= address[1]:
-                    match = True
-            elif address_type == "step":
-                if line_num >= address[0] and ((line_num - address[0]) % address[1]) == 0:
-                    match = True
-            elif address_type == "line":
-                if line_num == address:
-                    match = True
-            elif address_type == "regex":
-                if address.search(line):
-                    match = True
-
-            # match operations before echo line
-            if match:
-                # insert
-                if command == 'i':
-                    result = await self._say(acis_line, display_count, ctx.message.author, True, buffer,
-                                             pipe_out=pipe_out)
-                    if result == -1:
-                        await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                        return
-                    display_count += result
-                # print
-                elif command == 'p':
-                    result = await self._say(line, display_count, ctx.message.author, True, buffer, pipe_out=pipe_out)
-                    if result == -1:
-                        await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                        return
-                    display_count += result
-                # print line
-                elif command == '=':
-                    result = await self._say(str(line_num), display_count, ctx.message.author, True, buffer,
-                                             pipe_out=pipe_out)
-                    if result == -1:
-                        await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                        return
-                    display_count += result
-                # change
-                elif command == 'c':
-                    if address_type == "range" and line_num != address[0]:
-                        line = ''
-                    else:
-                        line = acis_line
-                # substitute
-                elif command == 's':
-                    if sub_search.search(line):
-                        sub_match = True
-                        line = re.sub(sub_search, sub_replace, line)
-
-            # echo line
-            if match:
-                # delete
-                if command == 'd':
-                    pass
-                # silent option - only print if s/././ matched and /p flag set
-                elif 'n' in option:
-                    # print substituted line
-                    if sub_match and sub_flag == 'p':
-                        result = await self._say(line, display_count, ctx.message.author, True, buffer,
-                                                 pipe_out=pipe_out)
-                        if result == -1:
-                            await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                            return
-                        display_count += result
-                    else:
-                        # do not print anything
-                        pass
-                else:
-                    # normal echo
-                    result = await self._say(line, display_count, ctx.message.author, True, buffer, pipe_out=pipe_out)
-                    if result == -1:
-                        await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                        return
-                    display_count += result
-            else:
-                # silent option
-                if 'n' in option:
-                    # do not print anything
-                    pass
+        time_slice = self.scheduler.start("sed", ctx, stdin)
+        try:
+            async for line in time_slice:
+                # run program on line
+                if sandboxed:
+                    line, output = line
                 else:
-                    # normal echo
-                    result = await self._say(line, display_count, ctx.message.author, True, buffer, pipe_out=pipe_out)
+                    output, state = program.run((line,), state)
+                    output = output[0]
+                for out_line in output:
+                    result = await self._say(out_line, display_count, ctx, True, buffer, pipe_out=pipe_out)
                     if result == -1:
-                        await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
+                        await self._flush_buffer(display_count, ctx, True, buffer, False)
                         return
                     display_count += result
-
-            # match operations after echo line
-            if match:
-                # append
-                if command == 'a':
-                    result = await self._say(acis_line, display_count, ctx.message.author, True, buffer,
-                                             pipe_out=pipe_out)
-                    if result == -1:
-                        await self._flush_buffer(display_count, ctx.message.author, True, buffer, False)
-                        return
-                    display_count += result
-
-            # reset sub_match
-            sub_match = False
+        finally:
+            time_slice.finish()
 
         # flush buffer
-        await self._flush_buffer(display_count, ctx.message.author, True, buffer, True)
+        await self._flush_buffer(display_count, ctx, True, buffer, True)
+
+        # tell user if script ran out of time
+        if sandboxed and stdin.timed_out:
+            await self._say("sed: script took longer than {} seconds; output is incomplete."
+                            .format(self.regex_pool.budget), 0, ctx, False, False)
 
         # handle pipe
         await self._pipe(ctx, pipe, pipe_out, redirect)
 
+    def _sed_script(self, script: str) -> list:
+        """ Parse sed script
+        :return:  list of commands, see SedProgram; None if script has no command
+        :raises ValueError: if script is not valid
+        """
+        sed_commands = {'a', 'c', 'd', 'i', 'p', 's', '='}
+        commands = []
+        pos = 0
+        while True:
+            # skip to next command
+            while pos < len(script) and script[pos] in " \t\n;":
+                pos += 1
+            if pos >= len(script):
+                break
+
+            # get address
+            first, pos = self._sed_address(script, pos)
+            last = None
+            if first is not None and script[pos:pos + 1] == ',':
+                last, pos = self._sed_address(script, pos + 1)
+                if last is None or last[0] == "step":
+                    raise ValueError("Unknown address after: `,`")
+            while pos < len(script) and script[pos] in " \t":
+                pos += 1
+
+            # check script again
+            if pos >= len(script) or script[pos] in "\n;":
+                return None
+
+            # get command
+            command = script[pos]
+            pos += 1
+            if command not in sed_commands:
+                raise ValueError("Unknown command: `{0}`".format(command))
+
+            text = search = replace = flags = occurrence = None
+            if command in ('a', 'c', 'i'):
+                # text runs to the end of the line
+                end = script.find("\n", pos)
+                if end == -1:
+                    end = len(script)
+                text = script[pos:end].strip()
+                if text[:1] == "\\":
+                    text = text[1:]
+                if not text:
+                    raise ValueError("Expected characters after: `{0}`".format(command))
+                pos = end
+            elif command == 's':
+                if script[pos:pos + 1] != '/':
+                    raise ValueError("Unknown substitution pattern: `{0}`".format(command))
+                pattern, pos = self._sed_delimited(script, pos + 1)
+                if pattern is not None:
+                    replace, pos = self._sed_delimited(script, pos)
+                if replace is None:
+                    raise ValueError("Unknown substitution pattern: `{0}`".format(command))
+                replace = replace.replace("\\/", "/")
+                end = pos
+                while end < len(script) and script[end].isalnum():
+                    end += 1
+                match = pattern_cache.compile(r"([a-zA-Z]*)(\d*)([a-zA-Z]*)$").match(script, pos, end)
+                if match is None:
+                    raise ValueError("Unrecognized pattern flag: `{0}`".format(command))
+                flags = (match.group(1) + match.group(3)).lower()
+                occurrence = int(match.group(2) or 1)
+                pos = end
+                if any(flag not in "gip" for flag in flags):
+                    raise ValueError("Unrecognized pattern flag: `{0}`".format(command))
+                if not occurrence:
+                    raise ValueError("Number option to `s` command may not be zero")
+                try:
+                    search = pattern_cache.compile(pattern, re.IGNORECASE if 'i' in flags else 0)
+                except re.error:
+                    raise ValueError("Error trying to create substitution pattern: `{0}`".format(pattern))
+
+            # only a separator may follow a command
+            while pos < len(script) and script[pos] in " \t":
+                pos += 1
+            if pos < len(script) and script[pos] not in "\n;":
+                raise ValueError("Extra characters after command: `{0}`".format(command))
+            commands.append((first, last, command, text, search, replace, flags, occurrence))
+
+        return commands or None
+
+    def _sed_address(self, script: str, pos: int) -> tuple:
+        """ Parse sed address at pos
+        :return:  (address, see SedProgram, or None if there is none, position after address)
+        :raises ValueError: if address is not valid
+        """
+        if script[pos:pos + 1] == '/':
+            source, end = self._sed_delimited(script, pos + 1)
+            if source is None:
+                raise ValueError("Unterminated address regex: `{0}`".format(script[pos:]))
+            # I or i ignores case, unless i is followed by the text of an insert command
+            flags = 0
+            if script[end:end + 1] == 'I' or script[end:end + 1] == 'i' and script[end + 1:end + 2] not in " \t\\":
+                flags = re.IGNORECASE
+                end += 1
+            try:
+                return ("regex", pattern_cache.compile(source, flags)), end
+            except re.error:
+                raise ValueError("Error trying to create substitution pattern: `{0}`".format(source))
+        elif script[pos:pos + 1] == '$':
+            return ("last",), pos + 1
+        match = pattern_cache.compile(r"(\d+)(?:~(\d+))?").match(script, pos)
+        if match is None:
+            return None, pos
+        if match.group(2) is not None:
+            return ("step", int(match.group(1)), int(match.group(2))), match.end()
+        return ("line", int(match.group(1))), match.end()
+
+    @staticmethod
+    def _sed_delimited(script: str, pos: int) -> tuple:
+        """ Text from pos up to the next '/' that is not escaped
+        :return:  (text or None if there is no '/', position after '/')
+        """
+        i = pos
+        while i < len(script):
+            if script[i] == '\\':
+                i += 2
+            elif script[i] == '/':
+                return script[pos:i], i + 1
+            else:
+                i += 1
+        return None, pos
+
     async def message_logger(self, message):
         """Log message - Credit https://github.com/tekulvw/Squid-Plugins"""
-        config = self._clog_get(message.channel.id)
-        # Do not log if logging is disabled for channel
-        if not config["active"]:
-            return
-        # Do not log if message from bot and log_bot disabled
-        if message.author == self.bot.user and not config["log_bot"]:
-            return
-        # Do not log if log_commands disabled and message starts with command prefix
-        if not config["log_commands"]:
-            if [s for s in self.bot.settings.get_prefixes(message.server) if message.clean_content.startswith(s)]:
-                return
-        # Log message
-        self.log(message)
+        rule = self._get_log_rule(message)
+        # Do not log if logging is disabled for channel, message is from bot and log_bot disabled,
+        # or log_commands disabled and message starts with command prefix
+        if rule is not None and rule.allows(message, self.bot.user):
+            self.log(LogRecord.from_message(message), rule.config)
+
+    async def prefix_listener(self, command, ctx):
+        """Drop cached logging decisions when command prefixes are changed"""
+        if command.qualified_name in self.prefix_commands:
+            self.log_rules.clear()
+            self.prefixes.clear()
 
     async def message_edit_logger(self, before, after):
         """Log message edits - Credit https://github.com/tekulvw/Squid-Plugins"""
-        new_message = copy.deepcopy(after)
-        new_content = ("EDIT:\nBefore: {}\nAfter: {}".format(before.clean_content, after.clean_content))
-        new_message.content = new_content
-        await self.message_logger(new_message)
-
-    def log(self, message):
-        """Write log to disk"""
-        sid = message.server.id
-        cid = message.channel.id
-
-        # Get log file path
-        folder = os.path.join(self.base_dir, sid)
-        if not os.path.exists(folder):
-            os.mkdir(folder)
-        file = os.path.join(folder, cid)
-
-        # Resize if needed
+        rule = self._get_log_rule(after)
+        if rule is not None and rule.allows(after, self.bot.user):
+            self.log(LogRecord.from_message(after, "edit", before.clean_content), rule.config)
+
+    def log(self, record, config):
+        """Queue log record for writing to disk"""
+        line = record.json() if config["format"] == "json" else record.text()
+        self.writer.write(record.sid, record.cid, line + "\n", config)
+
+    def _get_log_rule(self, message):
+        """Get cached logging decision for message's channel; None if channel is not logged"""
         try:
-            size = os.path.getsize(file)
-            if size > self.config[cid]["max_size"]:
-                bytes = self.config[cid]["max_size"] * -1 + self.log_buffer
-                with open(file, mode='rb+') as f:
-                    f.seek(bytes, os.SEEK_END)
-                    data = f.read()
-                    f.seek(0)
-                    f.write(data)
-                    f.truncate()
-        except:
-            # log file not created yet
-            pass
+            return self.log_rules[message.channel.id]
+        except KeyError:
+            return self._log_rule(message.channel.id, message.server)
+
+    def _log_rule(self, cid, server):
+        """Build and cache logging decision for channel"""
+        config = self._clog_get(cid)
+        rule = None
+        if config["active"] and server is not None:
+            if server.id not in self.prefixes:
+                self.prefixes[server.id] = tuple(self.bot.settings.get_prefixes(server))
+            rule = LogRule(config, self.prefixes[server.id])
+        self.log_rules[cid] = rule
+        return rule
+
+    async def _clog_backfill(self, ctx, num: int):
+        """ Import channel history from before the chat log started into the chat log
+        :param num:  max number of messages to fetch
+        """
+        channel = ctx.message.channel
+        server = ctx.message.server
+        sid = server.id
+        cid = channel.id
+        rule = self._log_rule(cid, server)
+        started = time.monotonic()
+
+        # only fetch messages older than the first logged line, or the clog command if nothing is logged yet
+        await self.writer.flush()
+        chat_log = self.writer.get_log(sid, cid)
+        first = await self.bot.loop.run_in_executor(None, chat_log.first_time)
+        if first is None:
+            before = ctx.message
+        else:
+            before = datetime.utcfromtimestamp(time.mktime(time.strptime(first, "%Y-%m-%d %H:%M:%S")))
+
+        # fetch history in pages, newest first
+        lines = []
+        fetched = 0
+        requests = 0
+        while fetched < num:
+            if requests:
+                await asyncio.sleep(self.backfill_interval)
+            limit = min(self.backfill_page, num - fetched)
+            page = []
+            async for message in self.bot.logs_from(channel, limit=limit, before=before):
+                page.append(message)
+            requests += 1
+            fetched += len(page)
+            for message in page:
+                if rule.allows(message, self.bot.user):
+                    record = LogRecord.from_message(message)
+                    lines.append(record.json() if rule.config["format"] == "json" else record.text())
+            if len(page) < limit:
+                break
+            before = page[-1]
+
+        lines.reverse()
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        await self.writer.prepend(sid, cid, data, rule.config)
 
-        # Write log
-        with open(file, encoding="utf-8", mode='a') as f:
-            timestamp = message.timestamp.replace(tzinfo=timezone.utc).astimezone(tz=None)
-            timestamp = str(timestamp)[:19]
-            message = ("{0} @{1.name}#{1.discriminator}: {2}\n".format(
-                timestamp, message.author, message.clean_content))
-            f.write(message)
+        seconds = max(time.monotonic() - started, 0.001)
+        await self.bot.say("Backfilled `{0}` of `{1}` fetched messages (`{2}`) with `{3}` requests in `{4:.1f}s`: "
+                           "`{5:.1f}` messages/s, `{6}`/s.".format(
+                               len(lines), fetched, self._size(len(data)), requests, seconds,
+                               fetched / seconds, self._size(len(data) / seconds)))
 
     def _clog_get(self, cid):
         """Get config options for channel"""
@@ -1515,10 +4214,11 @@ class GNU:
         """Set config options and save"""
 
         if cid not in self.config:
-            self.config[cid] = self.config_default
+            self.config[cid] = dict(self.config_default)
 
         for k, v in kwargs.items():
             self.config[cid][k] = v
+        self.log_rules.pop(cid, None)
         dataIO.save_json(self.config_path, self.config)
 
     def _size(self, num):
@@ -1548,6 +4248,7 @@ def setup(bot):
         n = GNU(bot)
         bot.add_listener(n.message_logger, 'on_message')
         bot.add_listener(n.message_edit_logger, 'on_message_edit')
+        bot.add_listener(n.prefix_listener, 'on_command_completion')
         bot.add_cog(n)
     else:
         raise RuntimeError("You need to run `pip3 install beautifulsoup4`")
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import os
+import sys
+import types
+
+import pytest
+
+# Cogs run inside Red-DiscordBot v2, which provides discord.ext.commands and cogs.utils; neither can be installed
+# on its own, so tests load the cog with stand-ins for the few parts of them it uses at import time.
+discord = types.ModuleType("discord")
+discord_ext = types.ModuleType("discord.ext")
+commands = types.ModuleType("discord.ext.commands")
+commands.command = lambda **attrs: (lambda func: func)
+discord.ext = discord_ext
+discord_ext.commands = commands
+
+cogs = types.ModuleType("cogs")
+utils = types.ModuleType("cogs.utils")
+data_io = types.ModuleType("cogs.utils.dataIO")
+checks = types.ModuleType("cogs.utils.checks")
+
+
+class DataIO:
+    @staticmethod
+    def load_json(path):
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def save_json(path, data):
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def is_valid_json(self, path):
+        try:
+            self.load_json(path)
+            return True
+        except (OSError, ValueError):
+            return False
+
+
+data_io.dataIO = DataIO()
+checks.is_owner = lambda: (lambda func: func)
+checks.admin_or_permissions = lambda **perms: (lambda func: func)
+cogs.utils = utils
+utils.dataIO = data_io
+utils.checks = checks
+
+sys.modules.update({"discord": discord, "discord.ext": discord_ext, "discord.ext.commands": commands,
+                    "cogs": cogs, "cogs.utils": utils, "cogs.utils.dataIO": data_io, "cogs.utils.checks": checks})
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gnu"))
+
+
+class Obj:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class Bot:
+    """Bot that records what it sends; answers is the list of replies wait_for_message returns, oldest first"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.user = Obj(name="bot", discriminator="0000", id="1")
+        self.sent = []
+        self.answers = []
+
+    async def say(self, content):
+        self.sent.append(content)
+
+    async def send_message(self, destination, content):
+        self.sent.append(content)
+
+    async def wait_for_message(self, timeout=None, author=None, **kwargs):
+        return Obj(content=self.answers.pop(0)) if self.answers else None
+
+
+class Context(Obj):
+    """Command context, as discord.ext.commands passes it to commands"""
+
+    async def invoke(self, command, *args, **kwargs):
+        return await command(self.cog, self, *args, **kwargs)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def bot(loop):
+    return Bot(loop)
+
+
+@pytest.fixture
+def cog(bot, tmp_path, monkeypatch):
+    import gnu
+    monkeypatch.chdir(tmp_path)
+    gnu.check_folders()
+    gnu.check_files()
+    cog = gnu.GNU(bot)
+    yield cog
+    getattr(cog, "_GNU__unload")()
+    # let cancelled tasks finish
+    bot.loop.run_until_complete(asyncio.sleep(0.01))
+
+
+@pytest.fixture
+def ctx(cog):
+    author = Obj(name="alice", discriminator="1234", id="5")
+    channel = Obj(id="20", is_private=False)
+    message = Obj(author=author, channel=channel, server=Obj(id="10"))
+    return Context(message=message, prefix="!", cog=cog)
@@ -0,0 +1,91 @@
+import re
+import time
+
+import gnu
+from conftest import Obj
+
+
+def output_lines(bot):
+    """Lines of command output the bot sent, without comment block fences"""
+    return [line for message in bot.sent for line in message.split("\n") if not line.startswith("```")]
+
+
+def test_pipe_output_in_order(cog, bot, ctx, loop):
+    # cat finishes before the grep it pipes to; the rest of grep's buffered output must still come out in order
+    cog.sender.per = 0.0
+    bot.answers = ["m"] * 100
+    text = "\n".join("line {0} {1}".format(i, "foo" if i % 3 == 0 else "bar") for i in range(3000))
+    for _ in range(3):
+        bot.sent.clear()
+        loop.run_until_complete(gnu.GNU.cat(cog, ctx, text, "|", "grep", "foo"))
+        loop.run_until_complete(cog.sender.drain(ctx.message.channel))
+        numbers = [int(match) for line in output_lines(bot) for match in re.findall(r"^line (\d+) ", line)]
+        assert numbers == list(range(0, 3000, 3))
+
+
+def test_history_after_stopped_output(cog, bot, ctx, loop):
+    # the user does not answer the more prompt, which stops output part way through the loop
+    cog.sender.per = 0.0
+    text = "\n".join("x" * 1000 + str(i) for i in range(40))
+    runs = [("cat", (text,)), ("tac", (text,)), ("grep", ("x", text)), ("sed", ("p", text))]
+    for name, args in runs:
+        bot.sent.clear()
+        loop.run_until_complete(getattr(gnu.GNU, name)(cog, ctx, *args))
+        loop.run_until_complete(cog.sender.drain(ctx.message.channel))
+        assert bot.sent[-1] == "Output stopped."
+        time_slice = cog.scheduler.history[-1]
+        assert time_slice.name == name
+        assert time_slice.finished is not None
+
+
+def record_send_times(bot):
+    """Make bot record time.monotonic() of each message it sends or says in bot.times"""
+    bot.times = []
+    send_message = bot.send_message
+    say = bot.say
+
+    async def timed_send_message(destination, content):
+        bot.times.append(time.monotonic())
+        await send_message(destination, content)
+
+    async def timed_say(content):
+        bot.times.append(time.monotonic())
+        await say(content)
+    bot.send_message = timed_send_message
+    bot.say = timed_say
+
+
+def assert_rate_limited(times, capacity, per):
+    for first, last in zip(times, times[capacity:]):
+        assert last - first >= per - 0.01
+
+
+def test_send_bucket(bot, loop):
+    record_send_times(bot)
+    sender = gnu.SendScheduler(bot, 1900, capacity=5, per=0.2)
+    channel = Obj(id="20")
+    author = Obj(id="5")
+
+    async def say_lines():
+        for i in range(30):
+            await sender.send(channel, author, "line {0}".format(i), False)
+        await sender.drain(channel)
+    loop.run_until_complete(say_lines())
+
+    # lines that queue up behind the limit are joined, in order, and messages never outrun the bucket
+    assert "\n".join(bot.sent) == "\n".join("line {0}".format(i) for i in range(30))
+    assert len(bot.sent) < 30
+    assert_rate_limited(bot.times, 5, 0.2)
+    sender.close()
+
+
+def test_more_prompt_spends_send_token(cog, bot, ctx, loop):
+    record_send_times(bot)
+    cog.sender.per = 0.2
+    bot.answers = ["m"]
+    text = "\n".join("x" * 1000 + str(i) for i in range(8))
+    loop.run_until_complete(gnu.GNU.cat(cog, ctx, "-%", text))
+    loop.run_until_complete(cog.sender.drain(ctx.message.channel))
+    assert bot.sent[4] == "Type 'more' or 'm' to continue..."
+    assert len(bot.sent) == 9
+    assert_rate_limited(bot.times, cog.sender.capacity, 0.2)